@@ -0,0 +1,342 @@
+'''Caches for data received from the Confluence server'''
+
+import hashlib
+import json
+import os
+import shelve
+
+from collections import OrderedDict
+from functools import lru_cache
+from pathlib import Path
+from pathlib import PosixPath
+from subprocess import CalledProcessError
+from subprocess import PIPE
+from subprocess import run
+from threading import Lock
+
+
+class PageCache:
+    '''
+    Cache of page contents (as returned by the Confluence REST API with
+    storage-format body) keyed by page id and version number. Together with
+    the content the page body split into parts (before, foliant, after) is
+    stored, so that the body doesn't have to be parsed again.
+
+    Recently used pages are kept in memory. If `path` is specified, pages are
+    also persisted in a shelve database so that subsequent builds may reuse
+    them. Only the latest known version of each page is persisted.
+    '''
+
+    def __init__(self, path: str or PosixPath or None = None, maxsize: int = 1024):
+        self._path = str(path) if path else None
+        self._maxsize = maxsize
+        self._memory = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, page_id: str or int, version: int) -> tuple or None:
+        '''
+        Return a tuple (content, parts) for the cached page version or None
+        if it is not cached.
+        '''
+        key = (str(page_id), version)
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+            if self._path is None:
+                return None
+            with shelve.open(self._path) as db:
+                stored = db.get(key[0])
+            if stored is None or stored['version'] != version:
+                return None
+            entry = (stored['content'], stored['parts'])
+            self._remember(key, entry)
+            return entry
+
+    def put(self, content: dict, parts: tuple):
+        '''
+        Store page content and its body parts. Content must contain page id
+        and version number.
+        '''
+        key = (str(content['id']), content['version']['number'])
+        with self._lock:
+            self._remember(key, (content, parts))
+            if self._path is not None:
+                with shelve.open(self._path) as db:
+                    db[key[0]] = {'version': key[1], 'content': content, 'parts': parts}
+
+    def _remember(self, key: tuple, entry: tuple):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        if len(self._memory) > self._maxsize:
+            self._memory.popitem(last=False)
+
+
+class FileCache:
+    '''
+    Conversion results, stored as files in the `path` dir and keyed by sha256
+    hashes. When the total size of the cache exceeds `max_size` bytes, least
+    recently used results are removed by `evict`.
+
+    Up to `memory_size` recently used results are also kept in memory, so that
+    results repeated within one build (e.g. common fragments of several pages)
+    are not read from disk again.
+    '''
+
+    def __init__(self,
+                 path: str or PosixPath,
+                 max_size: int = 512 * 1024 * 1024,
+                 memory_size: int = 256):
+        self._path = Path(path)
+        self._path.mkdir(parents=True, exist_ok=True)
+        self._max_size = max_size
+        self._memory_size = memory_size
+        self._memory = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: str) -> str or None:
+        '''Return the cached result or None if it is not cached'''
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+        path = self._path / f'{key}.html'
+        try:
+            with open(path, encoding='utf8') as f:
+                result = f.read()
+        except OSError:
+            return None
+        # modification time marks the last use, access time may be not updated
+        os.utime(path)
+        self._remember(key, result)
+        return result
+
+    def put(self, key: str, result: str):
+        path = self._path / f'{key}.html'
+        temp_path = path.with_name(f'{path.name}.{os.getpid()}.{id(result)}.tmp')
+        temp_path.write_bytes(result.encode('utf8'))
+        os.replace(temp_path, path)
+        self._remember(key, result)
+
+    def _remember(self, key: str, result: str):
+        with self._lock:
+            self._memory[key] = result
+            self._memory.move_to_end(key)
+            if len(self._memory) > self._memory_size:
+                self._memory.popitem(last=False)
+
+    def evict(self):
+        '''Remove least recently used results until the cache fits into max_size'''
+        files = []
+        for path in self._path.glob('*.html'):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self._max_size:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            total -= size
+
+
+class PandocCache(FileCache):
+    '''
+    Results of Pandoc conversions, keyed by the source, Pandoc version and
+    conversion parameters.
+    '''
+
+    def key(self, source: str, pandoc_path: str, *params: str) -> str:
+        '''Return the cache key for conversion of `source` with `params`'''
+        _hash = hashlib.sha256(_pandoc_version(pandoc_path).encode())
+        _hash.update(' '.join(params).encode())
+        _hash.update(b'\0')
+        _hash.update(source.encode())
+        return _hash.hexdigest()
+
+
+class StorageCache(FileCache):
+    '''
+    Results of conversions from editor to storage format made by the
+    Confluence server, keyed by the source and the server address.
+    '''
+
+    def key(self, source: str, host: str) -> str:
+        '''Return the cache key for conversion of `source` by the server at `host`'''
+        _hash = hashlib.sha256(host.encode())
+        _hash.update(b'\0')
+        _hash.update(source.encode())
+        return _hash.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def _pandoc_version(pandoc_path: str) -> str:
+    try:
+        return run([pandoc_path, '--version'], stdout=PIPE, check=True).stdout.decode()
+    except (OSError, CalledProcessError):
+        return ''
+
+
+class JsonCache:
+    '''
+    Records kept between builds in a JSON file. Changed records are kept in
+    memory and written to the file by `flush`.
+    '''
+
+    def __init__(self, path: str or PosixPath):
+        self._path = Path(path)
+        self._lock = Lock()
+        self._records = self._load()
+        self._changed = {}
+
+    def _load(self) -> dict:
+        try:
+            with open(self._path, encoding='utf8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _update(self, records: dict):
+        '''Add or replace `records`'''
+        with self._lock:
+            self._records.update(records)
+            self._changed.update(records)
+
+    def flush(self):
+        '''
+        Write changed records to disk. They are merged with the records currently
+        in the file, so that records saved by concurrent builds are not lost.
+        '''
+        with self._lock:
+            if not self._changed:
+                return
+            records = self._load()
+            records.update(self._changed)
+            # write to a temporary file first, so that an interrupted build
+            # doesn't leave a broken cache; pid keeps concurrent builds apart
+            tmp_path = self._path.with_name(f'{self._path.name}.{os.getpid()}.tmp')
+            with open(tmp_path, 'w', encoding='utf8') as f:
+                json.dump(records, f)
+            os.replace(tmp_path, self._path)
+            self._records = records
+            self._changed = {}
+
+
+class UploadCache(JsonCache):
+    '''
+    Record of pages uploaded by previous builds. For each page the signature
+    of the source it was built from, the page version after the upload and
+    the state of the local files attached to the page are kept, so that the
+    page may be skipped if none of those had changed.
+    '''
+
+    def check(self, key: str, signature: str, version: int or None = None) -> bool:
+        '''
+        Return True if the page `key` was uploaded from the source with the same
+        `signature` and none of its attachments had changed since. If `version`
+        is specified, it must also match the page version after the upload.
+        '''
+        record = self._records.get(key)
+        if not record or record['signature'] != signature:
+            return False
+        if version is not None and record['version'] != version:
+            return False
+        return all(_file_state(path) == state for path, state in record['files'].items())
+
+    def put(self, key: str, signature: str, version: int, files: list):
+        '''Save the record about uploaded page'''
+        record = {'signature': signature,
+                  'version': version,
+                  'files': {str(path): _file_state(path) for path in files}}
+        self._update({key: record})
+
+
+class PageStateCache(JsonCache):
+    '''
+    Hashes of the content uploaded to pages by previous builds, together with
+    the page versions after the upload. If the page still has the same version,
+    it is known to contain the content without checking it on the server.
+    '''
+
+    def check(self, page_id: str or int, version: int, title: str, content_hash: str) -> bool:
+        '''
+        Return True if the page of the `version` has the `title` and the content
+        with `content_hash`.
+        '''
+        record = {'version': version, 'title': title, 'hash': content_hash}
+        return self._records.get(str(page_id)) == record
+
+    def put(self, page_id: str or int, version: int, title: str, content_hash: str):
+        record = {'version': version, 'title': title, 'hash': content_hash}
+        self._update({str(page_id): record})
+
+
+class AttachmentCache(JsonCache):
+    '''
+    Hashes of attachments uploaded by previous builds together with the
+    attachment versions they were uploaded as. If the remote attachment still
+    has the same version, it doesn't have to be downloaded to find out whether
+    the local file had changed.
+    '''
+
+    def check(self, page_id: str or int, filename: str, version: int, file_hash: str) -> bool:
+        '''
+        Return True if the file with `file_hash` was uploaded to the page as
+        the attachment `filename` of the `version`.
+        '''
+        record = self._records.get(f'{page_id}/{filename}')
+        return record == {'version': version, 'hash': file_hash}
+
+    def put(self, page_id: str or int, attachments: list):
+        '''
+        Save the hashes of attachments of the page. `attachments` — list of
+        tuples (filename, version, file_hash).
+        '''
+        if attachments:
+            self._update({f'{page_id}/{filename}': {'version': version, 'hash': file_hash}
+                          for filename, version, file_hash in attachments})
+
+
+class FileHashCache(JsonCache):
+    '''
+    Hashes of local files attached to pages by previous builds, together with
+    the file states (modification time and size) they were calculated for.
+    Files which had not changed since don't have to be hashed again.
+    '''
+
+    def get(self, path: str or PosixPath) -> str or None:
+        '''Return the hash of the file or None if the file had changed since'''
+        record = self._records.get(str(path))
+        if record and record['state'] == _file_state(path):
+            return record['hash']
+        return None
+
+    def put(self, hashes: dict):
+        '''Save the hashes of files. `hashes` — dict {path: file_hash}.'''
+        if hashes:
+            self._update({str(path): {'state': _file_state(path), 'hash': _hash}
+                          for path, _hash in hashes.items()})
+
+
+def file_hash(path: str or PosixPath) -> str:
+    '''Return sha256 hash of the file contents'''
+    with open(path, 'rb') as f:
+        if hasattr(hashlib, 'file_digest'):  # Python 3.11+
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+        _hash = hashlib.sha256()
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            _hash.update(chunk)
+    return _hash.hexdigest()
+
+
+def _file_state(path: str or PosixPath) -> list or None:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
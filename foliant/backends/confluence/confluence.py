@@ -1,32 +1,71 @@
+import hashlib
+import json
 import os
+import re
 import shutil
-import yaml
 
+from collections import ChainMap
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
 from getpass import getpass
-
-from atlassian import Confluence
-from requests.exceptions import HTTPError
+from types import MappingProxyType
 
 from foliant.backends.base import BaseBackend
 from foliant.contrib.combined_options import Options
+from foliant.contrib.combined_options import ValidationError
 from foliant.contrib.combined_options import val_type
-from foliant.meta.generate import load_meta
-from foliant.preprocessors import flatten
-from foliant.preprocessors import unescapecode
 from foliant.utils import output
 from foliant.utils import spinner
 
+from .cache import AttachmentCache
+from .cache import FileHashCache
+from .cache import PageCache
+from .cache import PageStateCache
+from .cache import PandocCache
+from .cache import StorageCache
+from .cache import UploadCache
+from .constants import ATTACHMENT_CACHE_FILE_NAME
 from .constants import ATTACHMENTS_DIR_NAME
 from .constants import CACHEDIR_NAME
 from .constants import DEBUG_DIR_NAME
 from .constants import ESCAPE_DIR_NAME
-from .uploader import PageUploader
-
-# disabling confluence logger because it litters up output
-import atlassian.confluence
-
-from unittest.mock import Mock
-atlassian.confluence.log = Mock()
+from .constants import FILE_HASH_CACHE_FILE_NAME
+from .constants import FLAT_SRC_DIR_NAME
+from .constants import FLAT_WORK_DIR_NAME
+from .constants import PAGE_CACHE_DIR_NAME
+from .constants import PAGE_STATE_FILE_NAME
+from .constants import PANDOC_CACHE_DIR_NAME
+from .constants import STATE_DIR_NAME
+from .constants import STORAGE_CACHE_DIR_NAME
+from .constants import UPLOAD_CACHE_FILE_NAME
+from .constants import WORK_DIR_NAME
+
+# Confluence client, Pandoc and meta related modules are imported when they
+# are needed, so that this module is cheap to import when Foliant is making
+# other targets
+
+
+def val_positive_int(val) -> None:
+    '''Validator for options which must be positive integers'''
+    if isinstance(val, bool) or not isinstance(val, int) or val < 1:
+        raise ValidationError(f'Unsupported option value {val}. Must be a positive integer')
+
+
+# validators are shared by Options of all sections, so they are read-only
+OPTIONS_VALIDATORS = MappingProxyType({'host': val_type(str),
+                                       'login': val_type(str),
+                                       'password': val_type(str),
+                                       'id': val_type([str, int]),
+                                       'parent_id': val_type([str, int]),
+                                       'title': val_type(str),
+                                       'space_key': val_type(str),
+                                       'pandoc_path': val_type(str),
+                                       'concurrency': val_positive_int,
+                                       })
+REQUIRED_OPTIONS = (('id',),
+                    ('space_key', 'title'))
+# characters which are replaced in the names of section dirs
+UNSAFE_NAME_CHARS_RE = re.compile(r'[^\w.-]+')
 
 
 class Backend(BaseBackend):
@@ -53,7 +92,8 @@ class Backend(BaseBackend):
                 'test_run': False,
                 'verify_ssl': True,
                 'passfile': 'confluence_secrets.yml',
-                'cloud': False}
+                'cloud': False,
+                'concurrency': 8}
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -62,17 +102,52 @@ class Backend(BaseBackend):
         self._cachedir.mkdir(exist_ok=True)
 
         self._debug_dir = self._cachedir / DEBUG_DIR_NAME
-        shutil.rmtree(self._debug_dir, ignore_errors=True)
         self._debug_dir.mkdir(exist_ok=True)
+        # debug files are saved on every build (see test_run option), so the
+        # dir is kept and only files of the previous build are removed
+        with os.scandir(self._debug_dir) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                else:
+                    os.unlink(entry.path)
 
         self._flat_src_file_path = self._cachedir / self._flat_src_file_name
+        # flat source and signature of the sources it was made from are kept
+        # here between builds
+        self._flat_src_dir = self._cachedir / FLAT_SRC_DIR_NAME
         self._attachments_dir = self._cachedir / ATTACHMENTS_DIR_NAME
+        self._work_dir = self._cachedir / WORK_DIR_NAME
+
+        page_cache_dir = self._cachedir / PAGE_CACHE_DIR_NAME
+        page_cache_dir.mkdir(exist_ok=True)
+        self._page_cache = PageCache(page_cache_dir / 'pages')
+        # records kept between builds
+        self._state_dir = self._cachedir / STATE_DIR_NAME
+        self._state_dir.mkdir(exist_ok=True)
+        self._upload_cache = UploadCache(self._state_dir / UPLOAD_CACHE_FILE_NAME)
+        self._attachment_cache = AttachmentCache(self._state_dir / ATTACHMENT_CACHE_FILE_NAME)
+        self._page_state = PageStateCache(self._state_dir / PAGE_STATE_FILE_NAME)
+        self._hash_cache = FileHashCache(self._state_dir / FILE_HASH_CACHE_FILE_NAME)
+        self._pandoc_cache = PandocCache(self._cachedir / PANDOC_CACHE_DIR_NAME)
+        self._pandoc_cache.evict()
+        self._storage_cache = StorageCache(self._cachedir / STORAGE_CACHE_DIR_NAME)
+        self._storage_cache.evict()
+        # Pandoc servers for each pandoc_path, started on the first use
+        self._pandoc_servers = {}
+
         config = self.config.get('backend_config', {}).get('confluence', {})
         self.options = {**self.defaults, **config}
-        self.options = Options(self.options, required=['host'])
+        # concurrency is only taken from the backend config, so it's validated here
+        self.options = Options(self.options,
+                               validators={'concurrency': OPTIONS_VALIDATORS['concurrency']},
+                               required=['host'])
 
         self.logger = self.logger.getChild('confluence')
 
+        # (path, mtime) of the passfile and its parsed contents
+        self._passfile_cache = None
+
         self.logger.debug(f'Backend inited: {self.__dict__}')
 
     def _get_options(self, *configs, fallback_title=None) -> Options:
@@ -82,30 +157,277 @@ class Backend(BaseBackend):
 
         Returns the resulting Options object.
         '''
-        options = {}
-        if fallback_title:
-            options['title'] = fallback_title
-        for config in configs:
-            options.update(config)
-        options = Options(options,
-                          validators={'host': val_type(str),
-                                      'login': val_type(str),
-                                      'password': val_type(str),
-                                      'id': val_type([str, int]),
-                                      'parent_id': val_type([str, int]),
-                                      'title': val_type(str),
-                                      'space_key': val_type(str),
-                                      'pandoc_path': val_type(str),
-                                      },
-                          required=[('id',),
-                                    ('space_key', 'title')])
+        fallback = {'title': fallback_title} if fallback_title else {}
+        # later configs override earlier ones; missing and empty configs,
+        # e.g. of sections without own options, are skipped
+        maps = [config for config in reversed(configs) if config]
+        options = Options(dict(ChainMap(*maps, fallback)),
+                          validators=OPTIONS_VALIDATORS,
+                          required=REQUIRED_OPTIONS)
         return options
 
-    def _connect(self, host: str, login: str, password: str, verify_ssl: bool) -> Confluence:
+    def _convert_sections(self, jobs: list) -> list:
+        '''
+        Convert md sources of the sections to HTML, sending all sections with
+        the same pandoc_path to Pandoc server in one request if it's available.
+        Sections which were uploaded from the same source before are not
+        converted, they will be converted on upload if the page had changed.
+
+        `jobs` — list of tuples (section, uploader, md_source).
+
+        Returns a list of HTML strings (or None) in the order of `jobs`.
+        '''
+        from .convert import md_to_editor_batch
+
+        result = [None] * len(jobs)
+        groups = {}
+        for i, (_, uploader, md_source) in enumerate(jobs):
+            if uploader.is_cached(md_source):
+                continue
+            groups.setdefault(uploader.config['pandoc_path'], []).append(i)
+        for pandoc_path, indices in groups.items():
+            sources = [jobs[i][1].prepare_source(jobs[i][2]) for i in indices]
+            converted = md_to_editor_batch(sources,
+                                           self._cachedir,
+                                           pandoc_path,
+                                           self._get_pandoc_server(pandoc_path),
+                                           self._pandoc_cache)
+            for i, editor_content in zip(indices, converted):
+                result[i] = editor_content
+        return result
+
+    def _get_sources_signature(self) -> str:
+        '''Return sha256 of the chapters list and all md files in the working dir'''
+        _hash = hashlib.sha256(json.dumps(self.config['chapters'], sort_keys=True).encode())
+        for path in sorted(self.working_dir.rglob('*.md')):
+            _hash.update(str(path.relative_to(self.working_dir)).encode() + b'\0')
+            _hash.update(path.read_bytes())
+        return _hash.hexdigest()
+
+    def _make_flat_source(self):
+        '''
+        Make the flat md source of the project in self._flat_src_file_path.
+        If the sources had not changed since the previous build, the flat source
+        of that build is reused without running the preprocessors.
+        '''
+        from foliant.preprocessors import flatten
+        from foliant.preprocessors import unescapecode
+
+        saved_src_path = self._flat_src_dir / self._flat_src_file_name
+        signature_path = self._flat_src_dir / 'signature'
+        signature = self._get_sources_signature()
+        try:
+            saved_signature = signature_path.read_text(encoding='utf8')
+        except OSError:
+            saved_signature = None
+        if saved_signature == signature and saved_src_path.exists():
+            self.logger.debug('Sources had not changed, reusing flat source of the previous build')
+            shutil.copyfile(saved_src_path, self._flat_src_file_path)
+            return
+
+        flatten.Preprocessor(
+            self.context,
+            self.logger,
+            self.quiet,
+            self.debug,
+            {'flat_src_file_name': self._flat_src_file_name,
+             'keep_sources': True}
+        ).apply()
+
+        unescapecode.Preprocessor(
+            self.context,
+            self.logger,
+            self.quiet,
+            self.debug,
+            {}
+        ).apply()
+
+        shutil.move(self.working_dir / self._flat_src_file_name,
+                    self._flat_src_file_path)
+
+        self._flat_src_dir.mkdir(exist_ok=True)
+        shutil.copyfile(self._flat_src_file_path, saved_src_path)
+        signature_path.write_text(signature, encoding='utf8')
+
+    def _get_section_source(self, section, chapter_sources: dict) -> str:
+        '''
+        Same as section.get_source(), but each chapter file is read only once.
+        `chapter_sources` — dictionary of chapter sources read before.
+        '''
+        from foliant.meta.tools import remove_meta
+
+        filename = section.chapter.filename
+        if filename not in chapter_sources:
+            with open(filename, encoding='utf8') as f:
+                chapter_sources[filename] = f.read()
+        return remove_meta(chapter_sources[filename][section.start:section.end])
+
+    def _find_confluence_chapters(self, chapter_sources: dict) -> list:
+        '''
+        Find chapters which may contain sections with "confluence" field, so
+        that metadata is loaded only from them instead of all chapters.
+        Sources of the found chapters are saved into `chapter_sources`.
+
+        Returns a list of chapter names.
+        '''
+        from foliant.contrib.chapters import flatten_seq
+
+        result = []
+        for name in flatten_seq(self.config['chapters']):
+            path = self.working_dir / name
+            try:
+                source = path.read_text(encoding='utf8')
+            except OSError:  # missing chapters are skipped by load_meta anyway
+                continue
+            if 'confluence' in source:
+                chapter_sources[str(path)] = source
+                result.append(name)
+        return result
+
+    def _get_section_dir_name(self, num: int, title: str) -> str:
+        '''Name of the debug subdir for the section, unique within the build'''
+        return f'{num}_' + UNSAFE_NAME_CHARS_RE.sub('_', title)[:50]
+
+    def _prefetch_pages(self, jobs: list):
+        '''
+        Request all existing pages of the sections with a few CQL search
+        requests, instead of requesting each page when it is uploaded.
+
+        `jobs` — list of tuples (section, uploader, md_source).
+        '''
+        from .uploader import BadParamsException
+        from .wrapper import Page
+
+        ids = []
+        titles = {}
+        for _, uploader, _ in jobs:
+            config = uploader.config
+            if 'id' in config:
+                ids.append(config['id'])
+                continue
+            try:
+                parent_id = uploader.get_parent_id()
+            except BadParamsException as e:
+                # parent may be created by one of the sections of this build,
+                # it will be looked up again when the section is uploaded
+                self.logger.debug(f'Not prefetching page "{config["title"]}": {e}')
+                continue
+            titles.setdefault((config['space_key'], parent_id), []).append(config['title'])
+        self.logger.debug(f'Prefetching {len(ids)} pages by id and '
+                          f'{sum(map(len, titles.values()))} pages by title')
+        if ids:
+            Page.prefetch_by_ids(self.con, ids)
+        for (space_key, parent_id), group in titles.items():
+            Page.prefetch(self.con, space_key, parent_id, group)
+
+    def _get_pandoc_server(self, pandoc_path: str):
+        from .pandoc_server import PandocServer
+
+        if pandoc_path not in self._pandoc_servers:
+            self._pandoc_servers[pandoc_path] = PandocServer(pandoc_path)
+        return self._pandoc_servers[pandoc_path]
+
+    def _stop_pandoc_servers(self):
+        for server in self._pandoc_servers.values():
+            server.stop()
+        self._pandoc_servers = {}
+
+    def _upload_section(self, section, uploader, md_source: str, editor_content: str) -> str:
+        '''Upload one meta section to Confluence. Returns the result string.'''
+        self.logger.debug(f'Building {section.chapter.filename}: {section.title}')
+        output(f'Building {section.title}', self.quiet)
+        return uploader.upload(md_source, editor_content)
+
+    def _get_upload_waves(self, jobs: list) -> list:
+        '''
+        Split the jobs into waves which are uploaded one after another. A section
+        whose parent_title is the title of another section of this build is put
+        into a later wave than that section, so that the parent page is created
+        before it is looked up.
+
+        `jobs` — list of tuples (section, uploader, md_source).
+
+        Returns a list of lists of job indices, each in the order of `jobs`.
+        '''
+        titles = {}
+        for i, (_, uploader, _) in enumerate(jobs):
+            config = uploader.config
+            titles.setdefault((config.get('space_key'), config.get('title')), []).append(i)
+        deps = []
+        for i, (_, uploader, _) in enumerate(jobs):
+            config = uploader.config
+            if 'id' in config or 'parent_id' in config or 'parent_title' not in config:
+                deps.append(set())
+                continue
+            parents = titles.get((config.get('space_key'), config['parent_title']), [])
+            deps.append(set(parents) - {i})
+
+        waves = []
+        remaining = set(range(len(jobs)))
+        while remaining:
+            wave = [i for i in sorted(remaining) if not deps[i] & remaining]
+            if not wave:
+                # sections are parents of each other, upload them in the same wave
+                wave = sorted(remaining)
+            waves.append(wave)
+            remaining.difference_update(wave)
+        return waves
+
+    def _upload_sections(self, jobs: list, converted: list) -> list:
+        '''
+        Upload meta sections in parallel, using up to `concurrency` threads.
+        Sections are uploaded in waves (see _get_upload_waves), so that the
+        parent pages are created before their children.
+
+        `jobs` — list of tuples (section, uploader, md_source);
+        `converted` — list of HTML strings in the order of `jobs`.
+
+        Returns a list of result strings in the order of `jobs`.
+        '''
+        from requests.exceptions import HTTPError
+
+        result = [None] * len(jobs)
+        waves = self._get_upload_waves(jobs)
+        self.logger.debug(f'Uploading {len(jobs)} sections in {len(waves)} waves')
+        # the Confluence client is shared by the threads, its connection pool
+        # is sized for `concurrency` in _connect
+        workers = max(1, min(self.options['concurrency'], len(jobs)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for wave in waves:
+                futures = {executor.submit(self._upload_section, *jobs[i], converted[i]): i
+                           for i in wave}
+                for future in as_completed(futures):
+                    try:
+                        result[futures[future]] = future.result()
+                    except Exception as e:
+                        for pending in futures:
+                            pending.cancel()
+                        if isinstance(e, HTTPError):
+                            # reraising HTTPError with meaningful message
+                            raise HTTPError(e.response.text, e.response)
+                        raise
+        return result
+
+    def _connect(self, host: str, login: str, password: str, verify_ssl: bool):
         """Connect to Confluence server and test connection"""
+        from unittest.mock import Mock
+
+        import atlassian.confluence
+        from atlassian import Confluence
+
+        from .wrapper import POOL_SIZE
+        from .wrapper import UPLOAD_WORKERS
+        from .wrapper import configure_session
+
+        # disabling confluence logger because it litters up output
+        atlassian.confluence.log = Mock()
+
         self.logger.debug(f'Trying to connect to confluence server at {host}')
         host = host.rstrip('/')
         self.con = Confluence(host, login, password, verify_ssl=verify_ssl)
+        # each of the pages uploaded at the same time may upload several attachments
+        configure_session(self.con,
+                          max(POOL_SIZE, self.options['concurrency'] * UPLOAD_WORKERS))
         try:
             res = self.con.get('rest/api/space')
         except UnicodeEncodeError:
@@ -113,6 +435,31 @@ class Backend(BaseBackend):
         if isinstance(res, str) or 'statusCode' in res:
             raise RuntimeError(f'Cannot connect to {host}:\n{res}')
 
+    def _load_passfile(self) -> dict:
+        '''
+        Load the passfile. Parsed contents are reused until the file is
+        changed. Returns an empty dict if there's no passfile.
+        '''
+        import yaml
+        try:
+            from yaml import CSafeLoader as SafeLoader
+        except ImportError:
+            from yaml import SafeLoader
+
+        path = self.options['passfile']
+        self.logger.debug(f'Loading passfile {path}')
+        try:
+            with open(path, 'rb') as f:
+                key = (path, os.fstat(f.fileno()).st_mtime_ns)
+                if self._passfile_cache and self._passfile_cache[0] == key:
+                    return self._passfile_cache[1]
+                self.logger.debug(f'Found passfile at {path}')
+                passdict = yaml.load(f, SafeLoader) or {}
+        except FileNotFoundError:
+            return {}
+        self._passfile_cache = (key, passdict)
+        return passdict
+
     def _get_credentials(self, host: str) -> tuple:
         def get_password_for_login(login: str) -> str:
             if 'password' in self.options:
@@ -125,13 +472,7 @@ class Backend(BaseBackend):
                     msg = '\n!!! User input required !!!\n'
                     msg += f"Please input password for {login}:\n"
                     return getpass(msg)
-        self.logger.debug(f'Loading passfile {self.options["passfile"]}')
-        if os.path.exists(self.options['passfile']):
-            self.logger.debug(f'Found passfile at {self.options["passfile"]}')
-            with open(self.options['passfile'], encoding='utf8') as f:
-                passdict = yaml.load(f, yaml.Loader)
-        else:
-            passdict = {}
+        passdict = self._load_passfile()
         if 'login' in self.options:
             login = self.options['login']
             password = get_password_for_login(login)
@@ -152,6 +493,24 @@ class Backend(BaseBackend):
         Main method. Builds confluence XHTML document from flat md source and
         uploads it into the confluence server.
         '''
+        from requests.exceptions import HTTPError
+
+        from foliant.meta.generate import load_meta
+
+        from .uploader import PageUploader
+        from .uploader import get_content_id_by_title
+        from .wrapper import Page
+        from .wrapper import _check_parent
+        from .wrapper import _check_space
+
+        # parents found by title and checked spaces and parents are remembered
+        # for one build only, they may be renamed, moved or deleted between builds
+        get_content_id_by_title.cache_clear()
+        _check_space.cache_clear()
+        _check_parent.cache_clear()
+        # pages left from a failed build may be outdated
+        Page.clear_prefetched()
+
         host = self.options['host']
         credentials = self._get_credentials(host)
         self.logger.debug(f'Got credentials for host {host}: login {credentials[0]}, '
@@ -160,95 +519,110 @@ class Backend(BaseBackend):
                       *credentials,
                       self.options['verify_ssl'])
         result = []
-        if 'id' in self.options or ('title' in self.options and 'space_key' in self.options):
-            self.logger.debug('Uploading flat project to confluence')
-            output(f'Building main project', self.quiet)
-
-            flatten.Preprocessor(
-                self.context,
-                self.logger,
-                self.quiet,
-                self.debug,
-                {'flat_src_file_name': self._flat_src_file_name,
-                 'keep_sources': True}
-            ).apply()
-
-            unescapecode.Preprocessor(
-                self.context,
-                self.logger,
-                self.quiet,
-                self.debug,
-                {}
-            ).apply()
-
-            shutil.move(self.working_dir / self._flat_src_file_name,
-                        self._flat_src_file_path)
-
-            with open(self._flat_src_file_path, encoding='utf8') as f:
-                md_source = f.read()
-
-            options = self._get_options(self.options)
-
-            self.logger.debug(f'Options: {options}')
-            uploader = PageUploader(
-                self._flat_src_file_path,
-                options,
-                self.con,
-                self._cachedir,
-                self._debug_dir,
-                self._attachments_dir,
-                self.logger
-            )
-            try:
-                result.append(uploader.upload(md_source))
-            except HTTPError as e:
-                # reraising HTTPError with meaningful message
-                raise HTTPError(e.response.text, e.response)
-
-        self.logger.debug('Searching metadata for confluence properties')
-
-        chapters = self.config['chapters']
-        meta = load_meta(chapters, self.working_dir)
-        for section in meta.iter_sections():
-
-            if not isinstance(section.data.get('confluence'), dict):
-                self.logger.debug(f'No "confluence" section in {section}), skipping.')
-                continue
-
-            self.logger.debug(f'Found "confluence" section in {section}), preparing to build.')
-            # getting common options from foliant.yml and merging them with meta fields
-            common_options = {}
+        try:
+            if 'id' in self.options or ('title' in self.options and 'space_key' in self.options):
+                self.logger.debug('Uploading flat project to confluence')
+                output(f'Building main project', self.quiet)
+
+                self._make_flat_source()
+
+                md_source = self._flat_src_file_path.read_text(encoding='utf8')
+
+                options = self._get_options(self.options)
+
+                self.logger.debug(f'Options: {options}')
+                uploader = PageUploader(
+                    self._flat_src_file_path,
+                    options,
+                    self.con,
+                    self._cachedir,
+                    self._debug_dir,
+                    self._attachments_dir,
+                    self.logger,
+                    self._page_cache,
+                    self._work_dir / FLAT_WORK_DIR_NAME,
+                    upload_cache=self._upload_cache,
+                    attachment_cache=self._attachment_cache,
+                    pandoc_cache=self._pandoc_cache,
+                    storage_cache=self._storage_cache,
+                    page_state=self._page_state,
+                    hash_cache=self._hash_cache,
+                    debug=self.debug
+                )
+                try:
+                    result.append(uploader.upload(md_source,
+                                                  source_path=self._flat_src_file_path))
+                except HTTPError as e:
+                    # reraising HTTPError with meaningful message
+                    raise HTTPError(e.response.text, e.response)
+
+            self.logger.debug('Searching metadata for confluence properties')
+
+            chapter_sources = {}
+            chapters = self._find_confluence_chapters(chapter_sources)
+            meta = load_meta(chapters, self.working_dir)
+            shutil.rmtree(self._work_dir, ignore_errors=True)
+            sections = [section for section in meta.iter_sections()
+                        if isinstance(section.data.get('confluence'), dict)]
+            self.logger.debug(f'Found {len(sections)} sections with "confluence" field')
+
+            # getting common options from foliant.yml to merge them with meta fields
             uncommon_options = ['title', 'id', 'space_key', 'parent_id', 'attachments']
             common_options = {k: v for k, v in self.options.items()
                               if k not in uncommon_options}
-            try:
-                options = self._get_options(common_options,
-                                            section.data['confluence'],
-                                            fallback_title=section.title)
-            except Exception as e:
-                # output(f'Skipping section {section}, wrong params: {e}', self.quiet)
-                self.logger.debug(f'Skipping section {section}, wrong params: {e}')
-                continue
-            self.logger.debug(f'Building {section.chapter.filename}: {section.title}')
-            output(f'Building {section.title}', self.quiet)
-            md_source = section.get_source()
-
-            self.logger.debug(f'Options: {options}')
-            original_file = self.project_path / section.chapter.filename
-            uploader = PageUploader(
-                original_file,
-                options,
-                self.con,
-                self._cachedir,
-                self._debug_dir,
-                self._attachments_dir,
-                self.logger
-            )
-            try:
-                result.append(uploader.upload(md_source))
-            except HTTPError as e:
-                # reraising HTTPError with meaningful message
-                raise HTTPError(e.response.text, e.response)
+            jobs = []
+            for section in sections:
+                self.logger.debug(f'Found "confluence" section in {section}), preparing to build.')
+                try:
+                    options = self._get_options(common_options,
+                                                section.data['confluence'],
+                                                fallback_title=section.title)
+                except Exception as e:
+                    # output(f'Skipping section {section}, wrong params: {e}', self.quiet)
+                    self.logger.debug(f'Skipping section {section}, wrong params: {e}')
+                    continue
+                md_source = self._get_section_source(section, chapter_sources)
+
+                self.logger.debug(f'Options: {options}')
+                original_file = self.project_path / section.chapter.filename
+                debug_dir = self._debug_dir / self._get_section_dir_name(len(jobs),
+                                                                         options.get('title', ''))
+                uploader = PageUploader(
+                    original_file,
+                    options,
+                    self.con,
+                    self._cachedir,
+                    debug_dir,
+                    self._attachments_dir / str(len(jobs)),
+                    self.logger,
+                    self._page_cache,
+                    self._work_dir / str(len(jobs)),
+                    upload_cache=self._upload_cache,
+                    pandoc_server=self._get_pandoc_server(options['pandoc_path']),
+                    attachment_cache=self._attachment_cache,
+                    pandoc_cache=self._pandoc_cache,
+                    storage_cache=self._storage_cache,
+                    page_state=self._page_state,
+                    hash_cache=self._hash_cache,
+                    debug=self.debug
+                )
+                jobs.append((section, uploader, md_source))
+
+            # let Pandoc servers start while the pages are requested
+            for _, uploader, md_source in jobs:
+                if not uploader.is_cached(md_source):
+                    self._get_pandoc_server(uploader.config['pandoc_path']).start()
+            self._prefetch_pages(jobs)
+            converted = self._convert_sections(jobs)
+            result.extend(self._upload_sections(jobs, converted))
+        finally:
+            self._stop_pandoc_servers()
+            # records of the build are written once, even if it failed
+            for cache in (self._upload_cache,
+                          self._attachment_cache,
+                          self._page_state,
+                          self._hash_cache):
+                cache.flush()
         if result:
             return '\n' + '\n'.join(result)
         else:
@@ -3,3 +3,16 @@ ATTACHMENTS_DIR_NAME = 'attachments'
 DEBUG_DIR_NAME = 'debug'
 REMOTE_ATTACHMENTS_DIR_NAME = 'remote_attachments'
 ESCAPE_DIR_NAME = 'escaped'
+PAGE_CACHE_DIR_NAME = 'pages'
+PAGE_STATE_FILE_NAME = 'page_state.json'
+WORK_DIR_NAME = 'work'
+# workdir of the flat project uploader inside WORK_DIR_NAME
+FLAT_WORK_DIR_NAME = 'flat'
+# dir for records kept between builds
+STATE_DIR_NAME = 'state'
+UPLOAD_CACHE_FILE_NAME = 'upload_hashes.json'
+ATTACHMENT_CACHE_FILE_NAME = 'attachment_hashes.json'
+FILE_HASH_CACHE_FILE_NAME = 'file_hashes.json'
+PANDOC_CACHE_DIR_NAME = 'pandoc'
+FLAT_SRC_DIR_NAME = 'flat'
+STORAGE_CACHE_DIR_NAME = 'storage'
@@ -2,22 +2,44 @@ import os
 import re
 import shutil
 
+from html import escape
+from html import unescape
 from pathlib import Path
 from pathlib import PosixPath
+from subprocess import CalledProcessError
 from subprocess import PIPE
-from subprocess import STDOUT
 from subprocess import run
 
+import requests
+
 from atlassian import Confluence
-from bs4 import BeautifulSoup
-from bs4 import NavigableString
-from bs4 import CData
 
+from .cache import PandocCache
+from .cache import StorageCache
+from .pandoc_server import PandocServer
 from .ref_diff import restore_refs
 from .wrapper import Page
 
 logger = None
 
+IMAGE_RE = re.compile(r'<img(?:\s*[A-Za-z_:][0-9A-Za-z_:\-\.]*=".+?"\s*)+/?\s*>')
+IMAGE_ATTR_RE = re.compile(r'([A-Za-z_:][0-9A-Za-z_:\-\.]*)="(.*?)"')
+# image in <figure> tag, as Pandoc converts images with captions
+FIGURE_RE = re.compile(r'<figure>\s*<img src="(?P<path>.+?)" +(?:alt=".*?")?.+?>'
+                       r'(?:<figcaption>(?P<caption>.*?)</figcaption>)\s*</figure>')
+TITLE_RE = re.compile(r'^#{1,6} .+')
+ESCAPE_RE = re.compile(r"\[confluence_escaped[ \n\r]+hash=\%(?P<hash>.+?)\%\]")
+# newlines and whitespace at the start and end of strings between tags
+TAG_WHITESPACE_RE = re.compile(r'^\n|(\n\s*)+$')
+# tags, comments and CDATA sections, which are kept as is by unformat
+MARKUP_RE = re.compile(r'(<!\[CDATA\[.*?\]\]>|<!--.*?-->|<[^>]*>)', re.DOTALL)
+# opening or closing tag name
+TAG_NAME_RE = re.compile(r'<(?P<closing>/?)(?P<name>[A-Za-z][^\s/>]*)')
+# tags, in which html.parser doesn't collapse whitespace-only text
+PRESERVE_WHITESPACE_TAGS = ('pre', 'textarea')
+RI_ATTACHMENT_RE = re.compile(r'<ri:attachment\b[^>]*>')
+RI_FILENAME_RE = re.compile(r'\bri:filename=(["\'])(?P<value>.*?)\1')
+
 
 def crop_title(source: str) -> str:
     """
@@ -28,7 +50,7 @@ def crop_title(source: str) -> str:
     :returns: source string with the first title removed
     """
     result = source.lstrip()
-    if re.match('^#{1,6} .+', result):  # starts with a title
+    if TITLE_RE.match(result):  # starts with a title
         if '\n' in result:
             return result[result.index('\n') + 1:]
         else:
@@ -46,14 +68,18 @@ def fix_pandoc_images(source: str) -> str:
         image_caption = match.group('caption')
         image_path = match.group('path')
         result = f'<img src="{image_path}" alt="{image_caption}">'
-        logger.debug(f'\nold: {match.group(0)}\nnew: {result}')
+        logger.debug('\nold: %s\nnew: %s', match.group(0), result)
         return result
 
-    image_pattern = re.compile(r'<figure>\s*<img src="(?P<path>.+?)" +(?:alt=".*?")?.+?>(?:<figcaption>(?P<caption>.*?)</figcaption>)\s*</figure>')
-    return image_pattern.sub(_sub_image, source)
+    return FIGURE_RE.sub(_sub_image, source)
 
 
-def md_to_editor(source: str, temp_dir: PosixPath, pandoc_path: str = 'pandoc'):
+def md_to_editor(source: str,
+                 temp_dir: PosixPath or None = None,
+                 pandoc_path: str = 'pandoc',
+                 source_path: PosixPath or None = None,
+                 server: PandocServer or None = None,
+                 cache: PandocCache or None = None):
     """
     Convert md source string to HTML with Pandoc, fix pandoc image tags,
     for confluence doesn't understand <figure> and <figcaption> tags.
@@ -63,21 +89,62 @@ def md_to_editor(source: str, temp_dir: PosixPath, pandoc_path: str = 'pandoc'):
     Parameters:
 
     source — md-source to be converted;
-    temp_dir — directory for temporary files;
-    pandoc_path — custom path to pandoc binary.
+    temp_dir — not used, the source is passed to Pandoc through stdin. Kept
+               for compatibility;
+    pandoc_path — custom path to pandoc binary;
+    source_path — path to the file which already contains `source`. If
+                  specified, Pandoc reads it directly;
+    server — PandocServer which is used instead of running Pandoc if it is
+             available;
+    cache — PandocCache to take the result from, if the same source was
+            converted before.
     """
 
-    md_source = temp_dir / '0_markdown.md'
-    converted = temp_dir / '1_editor.html'
-    with open(md_source, 'w') as f:
-        f.write(source)
-    command = f'{pandoc_path} {md_source} -f markdown -t html -o {converted}'
+    if cache is not None:
+        key = cache.key(source, pandoc_path, 'markdown', 'html')
+        result = cache.get(key)
+        if result is not None:
+            logger.debug('Found converted source in Pandoc cache')
+            return result
+
+    result = _run_pandoc(source, pandoc_path, source_path, server)
+    if cache is not None:
+        cache.put(key, result)
+    return result
 
-    logger.debug('Converting MD to HTML with Pandoc, command:\n' + command)
-    run(command, shell=True, check=True, stdout=PIPE, stderr=STDOUT)
 
-    with open(converted) as f:
-        result = f.read()
+def _run_pandoc(source: str,
+                pandoc_path: str,
+                source_path: PosixPath or None,
+                server: PandocServer or None) -> str:
+    if server is not None and server.available:
+        logger.debug('Converting MD to HTML with Pandoc server')
+        try:
+            return fix_pandoc_images(server.convert(source))
+        except requests.RequestException as e:
+            logger.debug('Pandoc server failed to convert the source, running Pandoc: %s', e)
+
+    # the source is passed to Pandoc through stdin unless it's already in a file,
+    # the result is read from stdout
+    command = [pandoc_path, '-f', 'markdown', '-t', 'html']
+    if source_path is not None:
+        command.append(str(source_path))
+
+    logger.debug('Converting MD to HTML with Pandoc, command:\n' + ' '.join(command))
+    try:
+        p = run(command,
+                input=None if source_path is not None else source.encode('utf8'),
+                check=True,
+                stdout=PIPE,
+                stderr=PIPE)
+    except CalledProcessError as e:
+        logger.error(f'Pandoc failed to convert the source:\n{e.stderr.decode(errors="replace")}')
+        raise
+    if p.stderr:
+        logger.debug('Pandoc output:\n%s', p.stderr.decode(errors='replace'))
+
+    # Pandoc always writes UTF-8
+    result = p.stdout.decode('utf8')
 
     logger.debug('Fixing pandoc image captions.')
 
@@ -85,33 +152,100 @@ def md_to_editor(source: str, temp_dir: PosixPath, pandoc_path: str = 'pandoc'):
     return result
 
 
-def unique_name(dest_dir: str or PosixPath, old_name: str) -> str:
+def md_to_editor_batch(sources: list,
+                       temp_dir: PosixPath or None = None,
+                       pandoc_path: str = 'pandoc',
+                       server: PandocServer or None = None,
+                       cache: PandocCache or None = None) -> list:
+    """
+    Convert several md source strings to HTML. If Pandoc server is available,
+    all sources which are not cached are sent to it in one batch request, each
+    as a separate document. Otherwise, or if the request fails, the sources are
+    converted one by one with md_to_editor.
+
+    Return the list of resulting HTML strings in the order of `sources`.
+
+    Parameters:
+
+    sources — list of md-sources to be converted;
+    temp_dir — not used, kept for compatibility;
+    pandoc_path — custom path to pandoc binary;
+    server — PandocServer to convert the sources with;
+    cache — PandocCache with results of previous conversions.
+    """
+
+    result = [None] * len(sources)
+    keys = [None] * len(sources)
+    if cache is not None:
+        for i, source in enumerate(sources):
+            keys[i] = cache.key(source, pandoc_path, 'markdown', 'html')
+            result[i] = cache.get(keys[i])
+    pending = [i for i in range(len(sources)) if result[i] is None]
+    if len(pending) > 1 and server is not None and server.available:
+        logger.debug('Converting %s MD sources to HTML with Pandoc server', len(pending))
+        try:
+            converted = server.convert_batch([sources[i] for i in pending])
+        except (requests.RequestException, KeyError, TypeError) as e:
+            # unexpected response is treated as a failure too
+            logger.debug('Pandoc server failed to convert the sources: %r', e)
+        else:
+            for i, html in zip(pending, converted):
+                result[i] = fix_pandoc_images(html)
+                if cache is not None:
+                    cache.put(keys[i], result[i])
+
+    for i, source in enumerate(sources):
+        if result[i] is None:
+            result[i] = md_to_editor(source, pandoc_path=pandoc_path, server=server, cache=cache)
+    return result
+
+
+def unique_name(dest_dir: str or PosixPath, old_name: str, taken: set or None = None) -> str:
     """
     Check if file with old_name exists in dest_dir. If it does —
     add incremental numbers until it doesn't.
+
+    If `taken` set of names of files in dest_dir is specified, it is used
+    instead of checking the file system, and the new name is added to it.
+    Otherwise the dir is listed once.
     """
+    if taken is None:
+        try:
+            with os.scandir(dest_dir) as entries:
+                existing = {entry.name for entry in entries}
+        except FileNotFoundError:
+            existing = set()
+    else:
+        existing = taken
+
     counter = 1
-    dest_path = Path(dest_dir)
     name = old_name
-    while (dest_path / name).exists():
+    base, ext = os.path.splitext(old_name)
+    while name in existing:
         counter += 1
-        name = f'_{counter}'.join(os.path.splitext(old_name))
+        name = f'{base}_{counter}{ext}'
+    if taken is not None:
+        taken.add(name)
     return name
 
 
-def copy_with_unique_name(dest_dir: str or PosixPath, file_path: str or PosixPath) -> PosixPath:
+def copy_with_unique_name(dest_dir: str or PosixPath,
+                          file_path: str or PosixPath,
+                          taken: set or None = None) -> PosixPath:
     """
     Copy file_path file to dest_dir with unique name. Return path to copied file.
     Returns None if file_path doesn't exist.
+
+    `taken` — set of names of files in dest_dir, see unique_name.
     """
     if not os.path.exists(file_path):
-        logger.debug(f'{file_path} does not exist, skipping')
+        logger.debug('%s does not exist, skipping', file_path)
         return
-    new_name = unique_name(dest_dir, Path(file_path).name)
+    new_name = unique_name(dest_dir, Path(file_path).name, taken)
     new_path = Path(dest_dir) / new_name
 
-    logger.debug(f'Copying file {file_path} to: {new_path}')
-    shutil.copy(file_path, new_path)
+    logger.debug('Copying file %s to: %s', file_path, new_path)
+    shutil.copyfile(file_path, new_path)
     return new_path
 
 
@@ -119,156 +253,150 @@ def process_images(source: str,
                    rel_dir: str or Path,
                    attachment_manager) -> str:
     """
-    Cleanup target_dir. Copy local images to `target_dir` with unique names, replace their HTML
-    definitions in `source` with confluence definitions.
+    Add local images to the attachment manager, replace their HTML definitions
+    in `source` with confluence definitions. Image tags are parsed with regular
+    expressions in a single pass over the source.
 
     `source` — string with HTML source code to search images in;
     `rel_dir` — path relative to which image paths are determined.
     `attachment_manager` — AttachmentManager object.
 
-    Returns a tuple: (new_source, attachments)
-
-    new_source — a modified source with correct image paths
+    Returns a modified source with correct image paths.
     """
 
     def _sub(match):
-        image = BeautifulSoup(match.group(0), 'html.parser').find('img')
-        attrs = dict(image.attrs)
-        image_path = attrs.pop('src')
+        attrs = dict(IMAGE_ATTR_RE.findall(match.group(0)))
+        if 'src' not in attrs:
+            return match.group(0)
+        image_path = unescape(attrs.pop('src'))
 
         # leave external images as is
-        if image_path.startswith('http'):
+        if image_path.startswith(('http://', 'https://')):
             return match.group(0)
 
         image_path = Path(rel_dir) / image_path
 
-        logger.debug(f'Found image: {image}')
+        logger.debug('Found image: %s', match.group(0))
 
         new_path = attachment_manager.add_attachment(image_path)
         if not new_path:
-            logger.warning(f'Image {image_path} does not exist! Skipping')
+            logger.warning('Image %s does not exist! Skipping', image_path)
             return match.group(0)
 
-        # attachments.append(new_path)
-
         attrs = ' '.join(f'{k.replace("_", ":")}="{v}"' for k, v in attrs.items())
         img_ref = f'<ac:image {attrs}><ri:attachment ri:filename="{new_path.name}"/></ac:image>'
 
-        logger.debug(f'Converted image ref: {img_ref}')
+        logger.debug('Converted image ref: %s', img_ref)
         return img_ref
 
-    # # cleaning up target dir
-    # shutil.rmtree(target_dir, ignore_errors=True)
-    # Path(target_dir).mkdir()
-
-    image_pattern = re.compile(r'<img(?:\s*[A-Za-z_:][0-9A-Za-z_:\-\.]*=".+?"\s*)+/?\s*>')
-    # attachments = []
-
     logger.debug('Processing images')
 
-    return image_pattern.sub(_sub, source)  # , attachments
+    return IMAGE_RE.sub(_sub, source)
 
 
 def post_process_ac_image(escaped_content, parent_filename, attachment_manager):
     if not escaped_content.strip().startswith('<ac:image'):
         return escaped_content
 
-    logger.debug(f'Parsing confluence image: {escaped_content}')
-    root = BeautifulSoup(escaped_content, 'html.parser')
-    ac_image = root.find('ac:image')
-    if not ac_image:
-        logger.debug(f'ac:image tag not found, returning content as is')
-        return escaped_content
-
-    ri_attachment = ac_image.find('ri:attachment')
-    if not ri_attachment:
-        logger.debug(f'ri:attachment tag not found, returning content as is')
-        return escaped_content
-
-    src = ri_attachment.get('ri:filename')
-    if not src:
-        logger.debug(f'ri:filename attribute is not present, returning content as is')
-        return escaped_content
-
-    src = Path(src)
-
-    if not src.exists():
-        logger.debug(f'{src} does not exist, returning content as is')
-        return escaped_content
-
-    new_path = attachment_manager.add_attachment(src)
-
-    ri_attachment.attrs['ri:filename'] = new_path.name
-    return str(root)
+    logger.debug('Parsing confluence image: %s', escaped_content)
+    return _process_ri_attachment(escaped_content, attachment_manager)
 
 
 def post_process_ac_link(escaped_content, parent_filename, attachment_manager):
     if not escaped_content.strip().startswith('<ac:link'):
         return escaped_content
 
-    logger.debug(f'Parsing confluence link: {escaped_content}')
-    root = BeautifulSoup(escaped_content, 'html.parser')
-    ac_link = root.find('ac:link')
-    if not ac_link:
-        logger.debug(f'ac:link tag not found, returning content as is')
-        return escaped_content
+    logger.debug('Parsing confluence link: %s', escaped_content)
+    return _process_ri_attachment(escaped_content, attachment_manager)
+
 
-    ri_attachment = ac_link.find('ri:attachment')
-    if not ri_attachment:
-        logger.debug(f'ri:attachment tag not found, returning content as is')
+def _process_ri_attachment(escaped_content: str, attachment_manager) -> str:
+    """
+    Add the local file from ri:filename attribute of the first ri:attachment tag
+    to attachments and replace the attribute with the attachment name. The rest
+    of the content is returned as is.
+    """
+    tag = RI_ATTACHMENT_RE.search(escaped_content)
+    if not tag:
+        logger.debug('ri:attachment tag not found, returning content as is')
         return escaped_content
 
-    src = ri_attachment.get('ri:filename')
-    if not src:
-        logger.debug(f'ri:filename attribute is not present, returning content as is')
+    attr = RI_FILENAME_RE.search(tag.group(0))
+    if not attr or not attr.group('value'):
+        logger.debug('ri:filename attribute is not present, returning content as is')
         return escaped_content
 
-    src = Path(src)
+    src = Path(unescape(attr.group('value')))
 
     if not src.exists():
-        logger.debug(f'{src} does not exist, returning content as is')
+        logger.debug('%s does not exist, returning content as is', src)
         return escaped_content
 
     new_path = attachment_manager.add_attachment(src)
 
-    ri_attachment.attrs['ri:filename'] = new_path.name
-    return str(root)
+    start = tag.start() + attr.start('value')
+    end = tag.start() + attr.end('value')
+    return escaped_content[:start] + escape(new_path.name) + escaped_content[end:]
 
 
-def confluence_unescape(source: str, escape_dir: str or PosixPath) -> str:
+def confluence_unescape(source: str,
+                        escape_dir: str or PosixPath,
+                        post_process=None) -> str:
     '''
     Unescape bits of raw confluene code, escaped by confluence preprocessor.
 
     `source` — source string, potentially containing escaped raw confluence code;
-    `escape_dir` — a directory, containing saved original escaped code.
+    `escape_dir` — a directory, containing saved original escaped code;
+    `post_process` — function which receives each piece of the original code
+                     and returns it modified.
 
     Returns a modified source string with all escaped raw confluence code restored.
     '''
 
+    # the same code may be escaped several times on a page
+    restored = {}
+
     def _sub(match):
         filename = match.group('hash')
-        logger.debug(f'Restoring escaped confluence code with hash {filename}')
+        if filename in restored:
+            return restored[filename]
+        logger.debug('Restoring escaped confluence code with hash %s', filename)
         filepath = Path(escape_dir) / filename
         with open(filepath) as f:
-            return f.read().rstrip(os.linesep)
-    logger.warning(f'confluence_unescape {escape_dir}')
-    pattern = re.compile(r"\[confluence_escaped[ \n\r]+hash=\%(?P<hash>.+?)\%\]")
-    return pattern.sub(_sub, source)
-
-
-def editor_to_storage(con: Confluence, source: str) -> str:
+            escaped_content = f.read()
+        if post_process is not None:
+            escaped_content = post_process(escaped_content)
+        restored[filename] = escaped_content.rstrip(os.linesep)
+        return restored[filename]
+    logger.debug('confluence_unescape %s', escape_dir)
+    return ESCAPE_RE.sub(_sub, source)
+
+
+def editor_to_storage(con: Confluence,
+                      source: str,
+                      cache: StorageCache or None = None) -> str:
     """
     Convert source string from confluence editor format to storage format
     and return it. This method required a confluence connection.
 
     `con` — a Confluence connection;
-    `source` — original source in editor format.
+    `source` — original source in editor format;
+    `cache` — StorageCache to take the result from, if the same source was
+              converted by this server before.
 
     Returns a converted source in storage format.
     """
+    if cache is not None:
+        key = cache.key(source, con.url)
+        result = cache.get(key)
+        if result is not None:
+            logger.debug('Found converted source in storage format cache')
+            return result
     data = {"value": source, "representation": "editor"}
     res = con.post('rest/api/contentbody/convert/storage', data=data)
     if res and 'value' in res:
+        if cache is not None:
+            cache.put(key, res['value'])
         return res['value']
     else:
         raise RuntimeError('Cannot convert editor to storage. Got response:'
@@ -286,9 +414,12 @@ def add_comments(page: Page, new_content: str, resolve_changed: bool = False):
     logger.debug('Restoring inline comments.')
     if not page.exists:
         return new_content
+    if 'ac:inline-comment-marker' not in page.body:
+        logger.debug('Page has no inline comments.')
+        return new_content
 
-    resolved = page.get_resolved_comment_ids()
-    logger.debug(f'Got list of resolved comments in the text:\n{resolved}')
+    resolved = frozenset(page.get_resolved_comment_ids())
+    logger.debug('Got list of resolved comments in the text:\n%s', resolved)
 
     return restore_refs(page.body,
                         new_content,
@@ -306,13 +437,27 @@ def add_toc(source: str) -> str:
 
 def unformat(source: str):
     """remove whitespaces around HTML tags"""
-    p = re.compile(r'^\n|(\n\s*)+$')
-    bs = BeautifulSoup(source, 'html.parser')
-    to_replace = [s for s in bs.strings if not isinstance(s, CData) and p.search(s)]
-    for s in to_replace:
-        new_string = p.sub('', s)
-        s.replace_with(NavigableString(new_string))
-    return str(bs)
+    parts = MARKUP_RE.split(source)
+    # depth of tags, in which whitespace is preserved
+    preserve = 0
+    # split puts markup at odd indices, text between tags — at even ones
+    for i, part in enumerate(parts):
+        if i % 2:
+            match = TAG_NAME_RE.match(part)
+            if match and match.group('name').lower() in PRESERVE_WHITESPACE_TAGS:
+                if match.group('closing'):
+                    preserve = max(preserve - 1, 0)
+                elif not part.endswith('/>'):
+                    preserve += 1
+        elif part:
+            if not preserve and not part.strip(' \t\n\r\f'):
+                # whitespace-only text between tags is collapsed like
+                # html.parser does it: to a newline, which is then removed,
+                # or to a space
+                parts[i] = '' if '\n' in part else ' '
+            else:
+                parts[i] = TAG_WHITESPACE_RE.sub('', part)
+    return ''.join(parts)
 
 
 def set_up_logger(logger_):
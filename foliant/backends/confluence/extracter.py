@@ -1,12 +1,19 @@
 '''Collection of functions to extract the foliant section from
 confluence page source'''
 
-import re
+from html.parser import HTMLParser
+from itertools import accumulate
 
 from bs4 import BeautifulSoup
 
-OPEN_TAGS = ('foliant', 'foliant_start')
-CLOSE_TAGS = ('foliant_end', 'foliant_finish', 'foliant_close')
+OPEN_TAGS = frozenset(('foliant', 'foliant_start'))
+CLOSE_TAGS = frozenset(('foliant_end', 'foliant_finish', 'foliant_close'))
+# longer parameters are not anchor names and are not lowercased
+ANCHOR_NAME_MAX_LEN = max(map(len, OPEN_TAGS | CLOSE_TAGS))
+MACRO_TAG = 'ac:structured-macro'
+# elements without closing tags in HTML
+VOID_TAGS = frozenset(('area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+                       'link', 'meta', 'param', 'source', 'track', 'wbr'))
 
 
 def extract(source: str) -> (str, str, str):
@@ -19,6 +26,20 @@ def extract(source: str) -> (str, str, str):
 
     Return the tuple with these parts. Foliant tags not included.
     '''
+    if 'foliant' not in source.lower():
+        # no foliant tags, the whole page is the foliant part, no need to parse it
+        return '', source, ''
+    blocks = _scan_foliant_blocks(source)
+    if blocks is not None:
+        # the parts are sliced from the source, without building the tree
+        open_block, close_block = blocks
+        if open_block and close_block:
+            return source[:open_block[0]], source[open_block[1]:close_block[0]], source[close_block[1]:]
+        elif open_block:
+            return source[:open_block[0]], '', source[open_block[1]:]
+        return '', source, ''
+
+    # the source isn't well-formed, let BeautifulSoup deal with it
     b = BeautifulSoup(source, 'html.parser')
     open_anchor, close_anchor = detect_foliant_blocks(b)
     before = foliant = after = None
@@ -40,11 +61,11 @@ def extract(source: str) -> (str, str, str):
 def get_top_parent(element, root):
     '''Get and return closest to root parent of the element'''
     parent = element
-    while parent.parent != root:
-        parent = parent.parent
-        if parent is None:
-            return
-    return parent
+    for ancestor in element.parents:
+        if ancestor is root:
+            return parent
+        parent = ancestor
+    return None
 
 
 def get_content_between_two_tags(tag1, tag2) -> str:
@@ -52,12 +73,12 @@ def get_content_between_two_tags(tag1, tag2) -> str:
     Get HTML-code between `tag1` and `tag2` and return it as string.
     Tags not included.
     '''
-    ns = tag1.next_sibling
-    result = ''
-    while ns is not None and ns != tag2:
-        result += str(ns)
-        ns = ns.next_sibling
-    return result
+    result = []
+    for ns in tag1.next_siblings:
+        if ns is tag2:
+            break
+        result.append(str(ns))
+    return ''.join(result)
 
 
 def get_content_before_tag(tag, include_tag=False) -> str:
@@ -65,12 +86,11 @@ def get_content_before_tag(tag, include_tag=False) -> str:
     Get HTML-code before `tag` and return it as string.
     Tag's not included by default.
     '''
-    result = ''
-    bs = tag.previous_sibling
-    while bs is not None:
-        result = str(bs) + result
-        bs = bs.previous_sibling
-    return str(tag) + result if include_tag else result
+    result = [str(bs) for bs in tag.previous_siblings]
+    result.reverse()
+    if include_tag:
+        result.insert(0, str(tag))
+    return ''.join(result)
 
 
 def get_content_after_tag(tag, include_tag=False) -> str:
@@ -78,12 +98,10 @@ def get_content_after_tag(tag, include_tag=False) -> str:
     Get HTML-code after `tag` and return it as string.
     Tag's not included by default.
     '''
-    result = ''
-    ns = tag.next_sibling
-    while ns is not None:
-        result = result + str(ns)
-        ns = ns.next_sibling
-    return result + str(tag) if include_tag else result
+    result = [str(ns) for ns in tag.next_siblings]
+    if include_tag:
+        result.append(str(tag))
+    return ''.join(result)
 
 
 def detect_foliant_blocks(soup: BeautifulSoup) -> tuple:
@@ -91,21 +109,121 @@ def detect_foliant_blocks(soup: BeautifulSoup) -> tuple:
     Search the `soup` tree for foliant opening and closing tags.
     Return the tuple with the topmost parents of them.
     '''
-    def get_anchor_name(element):
-        for child in element.children:
-            if child.name == 'ac:parameter':
-                return child.text.lower()
-        return None
-    macros = soup.find_all(re.compile('ac:structured-macro'))
     open_anchor = close_anchor = None
-    for macro in macros:
-        if not open_anchor and get_anchor_name(macro) in OPEN_TAGS:
+    for macro in soup.find_all(MACRO_TAG):
+        param = macro.find('ac:parameter', recursive=False)
+        name = _anchor_name(param.text) if param is not None else None
+        if not open_anchor and name in OPEN_TAGS:
             open_anchor = macro
-        elif get_anchor_name(macro) in CLOSE_TAGS:
+        elif name in CLOSE_TAGS:
             close_anchor = macro
             break
     top_open = get_top_parent(open_anchor, soup) if open_anchor else None
     top_close = get_top_parent(close_anchor, soup) if close_anchor else None
-    if top_open == top_close:
+    if top_open is top_close:
         top_close = None
     return top_open, top_close
+
+
+def _anchor_name(text: str) -> str:
+    '''Return the text of macro parameter, lowercased if it may be an anchor name'''
+    return text.lower() if len(text) <= ANCHOR_NAME_MAX_LEN else text
+
+
+class _MalformedSource(Exception):
+    pass
+
+
+class _AnchorScanner(HTMLParser):
+    '''
+    Scans the source for foliant anchor macros without building the tree.
+    Collects offsets (start, end) of top-level elements in `blocks` and
+    tuples (anchor_name, block_index) for all macros in `macros`, where
+    anchor_name is the lowercased text of the first ac:parameter child
+    of the macro, or None.
+    '''
+
+    def __init__(self, source: str):
+        super().__init__(convert_charrefs=True)
+        self._source = source
+        self._line_starts = [0, *accumulate(len(line) + 1 for line in source.split('\n'))]
+        self.blocks = []
+        self.macros = []
+        # open elements: [tag, macro record or None]
+        self._stack = []
+        # text of the ac:parameter which is being read and its depth
+        self._param_text = None
+        self._param_depth = None
+
+    def _offset(self) -> int:
+        line, col = self.getpos()
+        return self._line_starts[line - 1] + col
+
+    def handle_starttag(self, tag, attrs, closed=False):
+        offset = self._offset()
+        if not self._stack:
+            self.blocks.append([offset, None])
+        parent = self._stack[-1] if self._stack else None
+        if tag == 'ac:parameter' and parent and parent[0] == MACRO_TAG \
+                and parent[1][0] is None and self._param_text is None:
+            self._param_text = []
+            self._param_depth = len(self._stack)
+        record = None
+        if tag == MACRO_TAG:
+            record = [None, len(self.blocks) - 1]
+            self.macros.append(record)
+        if closed or tag in VOID_TAGS:
+            if self._param_depth == len(self._stack):
+                self._end_param()
+            if not self._stack:
+                self.blocks[-1][1] = offset + len(self.get_starttag_text())
+            return
+        self._stack.append([tag, record])
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs, closed=True)
+
+    def handle_endtag(self, tag):
+        if not self._stack or self._stack[-1][0] != tag:
+            raise _MalformedSource(tag)
+        self._stack.pop()
+        if self._param_depth == len(self._stack):
+            self._end_param()
+        if not self._stack:
+            self.blocks[-1][1] = self._source.index('>', self._offset()) + 1
+
+    def handle_data(self, data):
+        if self._param_text is not None:
+            self._param_text.append(data)
+
+    def _end_param(self):
+        self._stack[-1][1][0] = _anchor_name(''.join(self._param_text))
+        self._param_text = self._param_depth = None
+
+
+def _scan_foliant_blocks(source: str) -> tuple or None:
+    '''
+    Find the top-level elements which contain foliant opening and closing
+    tags, like detect_foliant_blocks does, but without building the tree.
+    Return the tuple with offsets (start, end) of these elements or None's,
+    or None if the source isn't well-formed.
+    '''
+    scanner = _AnchorScanner(source)
+    try:
+        scanner.feed(source)
+        scanner.close()
+    except _MalformedSource:
+        return None
+    if scanner._stack:
+        return None
+    open_index = close_index = None
+    for name, index in scanner.macros:
+        if open_index is None and name in OPEN_TAGS:
+            open_index = index
+        elif name in CLOSE_TAGS:
+            close_index = index
+            break
+    if open_index == close_index:
+        close_index = None
+    return (scanner.blocks[open_index] if open_index is not None else None,
+            scanner.blocks[close_index] if close_index is not None else None)
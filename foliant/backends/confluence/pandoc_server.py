@@ -0,0 +1,125 @@
+'''Pandoc running in server mode, to avoid starting Pandoc for each conversion'''
+
+import atexit
+import socket
+import time
+
+from subprocess import DEVNULL
+from subprocess import Popen
+from threading import Lock
+
+import requests
+
+HOST = '127.0.0.1'
+# seconds to wait for the server to start accepting connections
+START_TIMEOUT = 5
+# seconds to wait for the conversion result
+REQUEST_TIMEOUT = 120
+
+
+class PandocServer:
+    '''
+    Pandoc server (`pandoc server`, available since Pandoc 3.0) running as
+    a subprocess. The server is started on the first use. If it can't be
+    started, e.g. because the installed Pandoc doesn't support the server mode,
+    `available` is False and Pandoc should be run as usual.
+    '''
+
+    def __init__(self, pandoc_path: str = 'pandoc'):
+        self.pandoc_path = pandoc_path
+        self._process = None
+        self._port = None
+        self._deadline = None
+        self._url = None
+        self._session = None
+        self._failed = False
+        self._lock = Lock()
+
+    @property
+    def available(self) -> bool:
+        with self._lock:
+            if self._url is None and not self._failed:
+                if self._process is None:
+                    self._failed = not self._launch()
+                if not self._failed:
+                    self._failed = not self._wait()
+        return not self._failed
+
+    def start(self):
+        '''
+        Start the server process without waiting for it to accept connections,
+        so that the server starts while the build is busy with something else.
+        '''
+        with self._lock:
+            if self._process is None and not self._failed:
+                self._failed = not self._launch()
+
+    def _launch(self) -> bool:
+        with socket.socket() as sock:
+            sock.bind((HOST, 0))
+            self._port = sock.getsockname()[1]
+        try:
+            self._process = Popen([self.pandoc_path, 'server', '--port', str(self._port)],
+                                  stdout=DEVNULL,
+                                  stderr=DEVNULL)
+        except OSError:
+            return False
+        self._deadline = time.monotonic() + START_TIMEOUT
+        # don't leave the server running if the build is aborted
+        # before the server is stopped
+        atexit.register(self.stop)
+        return True
+
+    def _wait(self) -> bool:
+        while time.monotonic() < self._deadline:
+            if self._process.poll() is not None:
+                return False
+            try:
+                socket.create_connection((HOST, self._port), timeout=0.1).close()
+            except OSError:
+                time.sleep(0.05)
+                continue
+            self._url = f'http://{HOST}:{self._port}/'
+            self._session = requests.Session()
+            return True
+        self._process.kill()
+        self._process.wait()
+        return False
+
+    def convert(self, source: str, from_: str = 'markdown', to: str = 'html') -> str:
+        '''
+        Convert `source` from format `from_` to format `to`. Raises
+        requests.RequestException if the conversion failed.
+        '''
+        res = self._session.post(self._url,
+                                 json={'text': source, 'from': from_, 'to': to},
+                                 headers={'Accept': 'application/json'},
+                                 timeout=REQUEST_TIMEOUT)
+        res.raise_for_status()
+        return res.json()['output']
+
+    def convert_batch(self, sources: list, from_: str = 'markdown', to: str = 'html') -> list:
+        '''
+        Convert all `sources` with one request to the server. Return the list
+        of results in the order of `sources`. Raises requests.RequestException
+        if any of the conversions failed.
+        '''
+        res = self._session.post(self._url + 'batch',
+                                 json=[{'text': source, 'from': from_, 'to': to}
+                                       for source in sources],
+                                 headers={'Accept': 'application/json'},
+                                 timeout=REQUEST_TIMEOUT)
+        res.raise_for_status()
+        return [item['output'] for item in res.json()]
+
+    def stop(self):
+        with self._lock:
+            if self._process is not None:
+                self._process.terminate()
+                self._process.wait()
+                self._process = None
+                self._url = None
+                atexit.unregister(self.stop)
+            if self._session is not None:
+                self._session.close()
+                self._session = None
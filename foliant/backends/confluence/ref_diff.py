@@ -1,17 +1,33 @@
-import re
-
+from bisect import bisect_right
 from collections import namedtuple
 from copy import copy
 from difflib import SequenceMatcher
 from pprint import pformat
+from sys import intern
 
 from bs4 import BeautifulSoup
 from bs4 import NavigableString
 from bs4 import Tag
 
+COMMENT_MARKER = 'ac:inline-comment-marker'
+
+Opcode = namedtuple('opcode', ('tag', 'a_s', 'a_e', 'b_s', 'b_e'))
+
 logger = None
 
 
+class _Pformat:
+    '''Pretty-printed object for logging, formatted only if the message is logged'''
+
+    __slots__ = ('obj',)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return pformat(self.obj)
+
+
 def restore_refs(old_content: str,
                  new_content: str,
                  resolved_ids: list,
@@ -27,14 +43,14 @@ def restore_refs(old_content: str,
     global logger
     logger = logger_
 
-    old_bs = BeautifulSoup(old_content, 'html.parser')
     new_bs = BeautifulSoup(new_content, 'html.parser')
-    if is_empty(new_bs):
+    new_strings = [s for s in new_bs.strings if s.strip()]
+    if not new_strings:
         logger.debug('New content is empty, all inline comments will be omitted.')
         return new_content
-    remove_outline_resolved(old_bs)
-    ref_dict = generate_ref_dict(old_bs)
-    new_strings = [s for s in new_bs.strings if s.strip()]
+    old_bs = BeautifulSoup(old_content, 'html.parser')
+    comments = remove_outline_resolved(old_bs)
+    ref_dict = generate_ref_dict(old_bs, comments)
     old_strings = [s for s in old_bs.strings if s.strip()]
     places = find_place2(old_strings, new_strings, ref_dict)
     correct_places(places, new_strings)
@@ -45,36 +61,26 @@ def restore_refs(old_content: str,
     return str(new_bs)
 
 
-def is_empty(soup):
-    '''Check whether `soup` is an empty page (whitespaces ignored)'''
-    for s in soup.strings:
-        if s.strip():
-            return False
-    return True
-
-
-def remove_outline_resolved(bs: BeautifulSoup):
+def remove_outline_resolved(bs: BeautifulSoup) -> list:
     """
     Remove from bs object all inline comments which have nested comments inside
     them. These may be only resolved comments, and they cause a lot of trouble.
     In place.
+
+    Returns the list of remaining inline comment tags in document order.
     """
     logger.debug('remove_outline_resolved START')
-    while True:
-        restart = False
-        comments = bs.find_all(re.compile('ac:inline-comment-marker'))
-        for comment in comments:
-            for child in comment.children:
-                if child.name == 'ac:inline-comment-marker':
-                    logger.debug(f'Comment has nested comments, removing: \n{comment}')
-                    basic_unwrap(comment)
-                    restart = True
-                    break
-            if restart:
-                break
+    # unwrapping a comment keeps other comment tags in the tree, so the tags
+    # found once may be processed in one pass
+    remaining = []
+    for comment in bs.find_all(COMMENT_MARKER):
+        if any(child.name == COMMENT_MARKER for child in comment.children):
+            logger.debug('Comment has nested comments, removing: \n%s', comment)
+            basic_unwrap(comment)
         else:
-            logger.debug('remove_outline_resolved END')
-            return
+            remaining.append(comment)
+    logger.debug('remove_outline_resolved END')
+    return remaining
 
 
 def basic_unwrap(element):
@@ -87,30 +93,44 @@ def basic_unwrap(element):
     <b>'One  Two  Three'</b>
     """
     parent = element.parent
+    before = element.previous_sibling
+    after = element.next_sibling
     element.unwrap()
-    groupped = []
-    accumulate = False
-    for el in parent.contents:
-        if isinstance(el, NavigableString):
-            if accumulate:
-                groupped[-1].append(el)
-            else:
-                groupped.append([el])
-                accumulate = True
+    # only the strings around the tag and inside it may have become adjacent,
+    # so the rest of the parent's contents is not scanned
+    node = before if before is not None else next(iter(parent.contents), None)
+    while isinstance(node, NavigableString) and \
+            isinstance(node.previous_sibling, NavigableString):
+        node = node.previous_sibling
+    group = []
+    reached_after = False
+    while node is not None:
+        next_node = node.next_sibling
+        if isinstance(node, NavigableString):
+            group.append(node)
         else:
-            accumulate = False
-    groupped = [g for g in groupped if len(g) > 1]
-    for g in groupped:
-        g[0].replace_with(''.join(g))
-        g.pop(0)
-        for i in g:
+            _join_strings(group)
+            group = []
+            if reached_after:
+                break
+        reached_after = reached_after or node is after
+        node = next_node
+    _join_strings(group)
+
+
+def _join_strings(group: list):
+    '''Replace adjacent NavigableStrings from the `group` with one string'''
+    if len(group) > 1:
+        group[0].replace_with(''.join(group))
+        for i in group[1:]:
             i.extract()
 
 
-def generate_ref_dict(bs: BeautifulSoup) -> dict:
+def generate_ref_dict(bs: BeautifulSoup, refs: list or None = None) -> dict:
     '''
     Receives a BeautifulSoup object and generates a dictionary with info about
-    inline comments.
+    inline comments. If the list of inline comment tags `refs` was already
+    found, the tree is not searched again.
 
     Output dictionary structure:
 
@@ -136,14 +156,15 @@ def generate_ref_dict(bs: BeautifulSoup) -> dict:
     logger.debug('generate_ref_dict START')
     logger.debug('Collecting comments from the old article (remote)')
     result = {}
-    refs = bs.find_all(re.compile('ac:inline-comment-marker'))
+    if refs is None:
+        refs = bs.find_all(COMMENT_MARKER)
     for ref in refs:
         ref_id = ref.attrs['ac:ref']
         try:
             full, (before, comment, after) = unwrap(ref)
         except RuntimeError:
             logger.debug("Inline comment tag has other tags inside. We can't"
-                         f" process such yet, skipping:\n{ref}")
+                         " process such yet, skipping:\n%s", ref)
             continue
         cs = dict(full=full,
                   ref_id=ref_id,
@@ -156,7 +177,7 @@ def generate_ref_dict(bs: BeautifulSoup) -> dict:
         if cs['before'] and id(cs['before']) in result:
             cs['before'] = result.pop(id(cs['before']))
         result[id(cs['full'])] = cs
-    logger.debug(f'Collected comments:\n\n{pformat(result)}')
+    logger.debug('Collected comments:\n\n%s', _Pformat(result))
     logger.debug('generate_ref_dict END')
     return result
 
@@ -212,31 +233,41 @@ def find_place2(old_strings, new_strings: list, ref_dict: dict) -> dict:
     '''
     logger.debug('find_place2 START')
     result = []
-
-    # strip all strings from indentations and formatting for comparison
-    s_old_strings = [s.strip() for s in old_strings]
-    s_new_strings = [s.strip() for s in new_strings]
-
-    sm = SequenceMatcher(None, s_old_strings, s_new_strings)
-    sm.ratio()
-    Opcode = namedtuple('opcode', ('tag', 'a_s', 'a_e', 'b_s', 'b_e'))
-    opcodes = [Opcode(*opc) for opc in sm.get_opcodes()]
-    logger.debug(f'Opcodes after matching: {sm.get_opcodes()}')
+    if not ref_dict:
+        logger.debug('find_place2 END')
+        return result
+
+    # strip all strings from indentations and formatting for comparison,
+    # equal strings are interned to be compared by identity
+    s_old_strings = [intern(s.strip()) for s in old_strings]
+    s_new_strings = [intern(s.strip()) for s in new_strings]
+
+    if s_old_strings == s_new_strings:
+        # text wasn't changed, no need to diff
+        opcodes = [Opcode('equal', 0, len(old_strings), 0, len(new_strings))]
+    else:
+        # repeated strings must not be treated as junk, comments may be on them
+        sm = SequenceMatcher(None, s_old_strings, s_new_strings, autojunk=False)
+        opcodes = list(map(Opcode._make, sm.get_opcodes()))
+    logger.debug('Opcodes after matching: %s', opcodes)
 
     # We use IDs to determine the correct string because the tree may contain
     # strings with equal values, but located in different parts of the tree. ID
     # allows to determine the correct string precisely.
-    old_string_ids = [id(s) for s in old_strings]
+    old_string_indices = {}
+    for ind, s in enumerate(old_strings):
+        old_string_indices.setdefault(id(s), ind)
+    # opcodes are sorted by the position in old strings
+    opcode_starts = [opc.a_s for opc in opcodes]
     for cs_id in ref_dict:
         equal = False
-        ind = old_string_ids.index(cs_id)
+        ind = old_string_indices[cs_id]
 
-        for i in range(len(opcodes)):
-            if opcodes[i].a_s <= ind < opcodes[i].a_e:
-                break
-        else:
-            i = None
-        if i is None:
+        # the last opcode starting at ind or before it, skipping empty ones
+        i = bisect_right(opcode_starts, ind) - 1
+        while i >= 0 and opcodes[i].a_s == opcodes[i].a_e:
+            i -= 1
+        if i < 0 or not opcodes[i].a_s <= ind < opcodes[i].a_e:
             continue
 
         if opcodes[i].tag == 'equal':
@@ -254,7 +285,7 @@ def find_place2(old_strings, new_strings: list, ref_dict: dict) -> dict:
                 indeces.append(opcodes[i].b_s - 1 if opcodes[i].b_s else 0)
                 indeces.append(opcodes[i].b_e if opcodes[i].b_e + 1 <= len(new_strings) else opcodes[i].b_e - 1)
         result.append((ref_dict[cs_id], indeces, equal))
-    logger.debug(f'List of found places:\n\n{pformat(result)}')
+    logger.debug('List of found places:\n\n%s', _Pformat(result))
     logger.debug('find_place2 END')
     return result
 
@@ -263,13 +294,19 @@ def add_unique(a: list, b: list, at_beginning: bool = True) -> None:
     '''
     Add only unique elements from b to a in place.
     If `at_beginning` is True — elements are inserted at the beginning
-    of the a list. If False — they are appended at the end.'''
+    of the a list (each one before the previous). If False — they are
+    appended at the end.'''
+    present = set(a)
+    new = []
     for i in b:
-        if i not in a:
-            if at_beginning:
-                a.insert(0, i)
-            else:
-                a.append(i)
+        if i not in present:
+            present.add(i)
+            new.append(i)
+    if at_beginning:
+        new.reverse()
+        a[:0] = new
+    else:
+        a.extend(new)
 
 
 def correct_places(places: list, strings: list):
@@ -284,24 +321,31 @@ def correct_places(places: list, strings: list):
                     right now a part of the tree.
     '''
     logger.debug('correct_places START')
+    # name of the macro each string is inside of, strings are often
+    # referenced by several places
+    macros = {}
     for place in places:
-        to_remove = []
-        for i in range(len(place[1])):
-            index = place[1][i]
-            cur = strings[index]
-            while cur:
-                if cur.name and cur.name.startswith('ac:'):
-                    logger.debug(f"string '{strings[index]}' is inside macro {cur.name}"
-                                 " and will be removed")
-                    to_remove.append(i)
-                    break
-                cur = cur.parent
-        for i in reversed(to_remove):
-            s = place[1].pop(i)
-            logger.debug(f"Removed string [{s}]: '{strings[s]}'")
+        kept = []
+        for index in place[1]:
+            if index not in macros:
+                macros[index] = _get_macro_name(strings[index])
+            if macros[index] is None:
+                kept.append(index)
+            else:
+                logger.debug("string '%s' is inside macro %s and will be removed",
+                             strings[index], macros[index])
+        place[1][:] = kept
     logger.debug('correct_places END')
 
 
+def _get_macro_name(string) -> str or None:
+    '''Return the name of the closest confluence-tag containing `string`'''
+    for parent in string.parents:
+        if parent.name and parent.name.startswith('ac:'):
+            return parent.name
+    return None
+
+
 def divide_places(places: list) -> dict:
     '''
     Takes a list of tuples, got from find_place2 function:
@@ -327,11 +371,9 @@ def divide_places(places: list) -> dict:
                     for info_dict, indeces, equal in places if equal]
 
     # remove all places where equal strings are mentioned
-    for _, equal_indeces, _ in equal_places:
-        for _, indeces, _ in places:
-            equal_index = equal_indeces[0]
-            if equal_index in indeces:
-                indeces.pop(indeces.index(equal_index))
+    equal_indeces = {indeces[0] for _, indeces, _ in equal_places}
+    for _, indeces, _ in places:
+        indeces[:] = [index for index in indeces if index not in equal_indeces]
 
     # remove all places where strings are empty after prev. stage
     places = [p for p in places if p[1]]
@@ -343,15 +385,17 @@ def divide_places(places: list) -> dict:
             add_unique(refs, get_refs(info_dict['before']))
         return refs
 
-    # make a dictionary with refs list for each string index
+    # make a dictionary with refs list for each string index, refs are
+    # gathered in dicts to keep them unique and ordered
     unequal = {}
     for info_dict, indeces, _ in places:
-        refs = get_refs(info_dict)
+        refs = dict.fromkeys(get_refs(info_dict))
         for pos in indeces:
-            add_unique(unequal.setdefault(pos, []), refs, False)
+            unequal.setdefault(pos, {}).update(refs)
+    unequal = {pos: list(refs) for pos, refs in unequal.items()}
 
-    logger.debug(f'Equal places:\n\n{pformat(equal_places)}\n\n'
-                 f'References for changed strings:\n\n{pformat(unequal)}')
+    logger.debug('Equal places:\n\n%s\n\nReferences for changed strings:\n\n%s',
+                 _Pformat(equal_places), _Pformat(unequal))
     logger.debug('divide_places END')
     return equal_places, unequal
 
@@ -389,15 +433,15 @@ def restore_equal_refs(places: list, new_strings: list) -> None:
     logger.debug('restore_equal_refs START')
 
     for info_dict, indeces, _ in places:
-        logger.debug(f'Source info_dict:\n\n{pformat(info_dict)}')
+        logger.debug('Source info_dict:\n\n%s', _Pformat(info_dict))
 
         content_list = get_content_list(info_dict)
 
-        logger.debug(f'Content list to insert:\n\n{pformat(content_list)}')
+        logger.debug('Content list to insert:\n\n%s', _Pformat(content_list))
 
         target = new_strings[indeces[0]]
 
-        logger.debug(f'String to be replaced: {target}')
+        logger.debug('String to be replaced: %s', target)
 
         # we use copy to detach element from previous tree
         new_elem = copy(content_list[0])
@@ -430,28 +474,28 @@ def insert_unequal_refs(unequal: dict, new_strings: list, resolved_ids: list):
     '''
     logger.debug('insert_unequal_refs START')
     for pos, refs in unequal.items():
-        logger.debug(f'Inserting refs into string #{pos}')
+        logger.debug('Inserting refs into string #%s', pos)
         if len(refs) > 1:
             logger.debug('More than one ref claim for this string.'
-                         'Leaving out resolved: '
-                         f'{[ref for ref in refs if ref in resolved_ids]}')
+                         'Leaving out resolved: %s',
+                         [ref for ref in refs if ref in resolved_ids])
             refs = [ref for ref in refs if ref not in resolved_ids]
             if not refs:
                 logger.debug('All refs for the string were resolved. Skipping')
                 continue
 
-        logger.debug(f'Refs to insert: {refs}')
+        logger.debug('Refs to insert: %s', refs)
 
         contents = []
         ns = new_strings[pos]
 
-        logger.debug(f'String to be replaced: {ns}')
+        logger.debug('String to be replaced: %s', ns)
 
         # if number of refs more than chars in string — ignore the rest
         num_refs = min(len(refs), len(ns))
         chunk_size = len(ns) // num_refs
 
-        logger.debug(f'Dividing string equally into {num_refs} chunks by {chunk_size} chars.')
+        logger.debug('Dividing string equally into %s chunks by %s chars.', num_refs, chunk_size)
 
         for i in range(num_refs):
             tag = Tag(name='ac:inline-comment-marker',
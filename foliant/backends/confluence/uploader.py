@@ -1,16 +1,27 @@
+import hashlib
+import json
 import os
-import re
 import shutil
 
 from atlassian import Confluence
+from filecmp import cmp
+from functools import lru_cache
 from foliant.contrib.combined_options import Options
 from pathlib import Path
 from pathlib import PosixPath
 
+from .cache import AttachmentCache
+from .cache import FileHashCache
+from .cache import PageCache
+from .cache import PageStateCache
+from .cache import PandocCache
+from .cache import StorageCache
+from .cache import UploadCache
 from .constants import ESCAPE_DIR_NAME
 from .constants import REMOTE_ATTACHMENTS_DIR_NAME
 from .convert import add_comments
 from .convert import add_toc
+from .convert import confluence_unescape
 from .convert import copy_with_unique_name
 from .convert import crop_title
 from .convert import editor_to_storage
@@ -21,6 +32,7 @@ from .convert import process_images
 from .convert import unformat
 from .convert import set_up_logger
 from .convert import unique_name
+from .pandoc_server import PandocServer
 from .wrapper import Page
 
 
@@ -41,25 +53,40 @@ class AttachmentManager:
 
     def cleanup(self):
         shutil.rmtree(self.dir, ignore_errors=True)
-        self.dir.mkdir()
+        self.dir.mkdir(parents=True)
+        # names of files in the dir, to find unique names without checking the disk
+        self.names = set()
+        # copied files by original name and size, to find files with the same content
+        self.copies = {}
 
     def add_attachment(self, file_path: str or PosixPath) -> PosixPath or None:
         abs_path = str(Path(file_path).resolve())
-        self.logger.debug(f'Adding attachment: {abs_path}')
+        self.logger.debug('Adding attachment: %s', abs_path)
 
         if abs_path in self.registry:
-            self.logger.debug(f'Attachment found in registry, returning {self.registry[abs_path]}')
+            self.logger.debug('Attachment found in registry, returning %s', self.registry[abs_path])
             return self.registry[abs_path]
-        else:
-            new_path = copy_with_unique_name(self.dir, file_path)
-            if new_path:
-                self.registry[abs_path] = new_path
-            self.logger.debug(f'Copied to attachments dir, returning {new_path}')
-            return new_path  # may be None
+        try:
+            copy_key = (Path(file_path).name, os.stat(file_path).st_size)
+        except OSError:
+            copy_key = None
+        for copy_path in self.copies.get(copy_key, ()):
+            if cmp(file_path, copy_path, shallow=False):
+                # same file in another dir, upload it once
+                self.logger.debug('Attachment with the same content found, returning %s', copy_path)
+                self.registry[abs_path] = copy_path
+                return copy_path
+        new_path = copy_with_unique_name(self.dir, file_path, self.names)
+        if new_path:
+            self.registry[abs_path] = new_path
+            self.copies.setdefault(copy_key, []).append(new_path)
+        self.logger.debug('Copied to attachments dir, returning %s', new_path)
+        return new_path  # may be None
 
     @property
     def attachments(self):
-        return list(self.registry.values())
+        # several files may share one copy
+        return list(dict.fromkeys(self.registry.values()))
 
 
 class PageUploader:
@@ -71,7 +98,17 @@ class PageUploader:
         cachedir: PosixPath,
         debug_dir: PosixPath,
         attachments_dir: PosixPath,
-        logger
+        logger,
+        page_cache: PageCache or None = None,
+        workdir: PosixPath or None = None,
+        upload_cache: UploadCache or None = None,
+        pandoc_server: PandocServer or None = None,
+        attachment_cache: AttachmentCache or None = None,
+        pandoc_cache: PandocCache or None = None,
+        storage_cache: StorageCache or None = None,
+        page_state: PageStateCache or None = None,
+        debug: bool = False,
+        hash_cache: FileHashCache or None = None
     ):
         self.md_file_path = Path(md_file_path)
         self.config = config
@@ -80,29 +117,90 @@ class PageUploader:
         self.debug_dir = debug_dir
         self.attachment_manager = AttachmentManager(attachments_dir, logger)
         self.logger = logger
+        self.page_cache = page_cache
+        # dir for temporary and debug files of this uploader, separate dirs
+        # allow several uploaders to work at the same time
+        self.workdir = workdir or cachedir
+        self.workdir.mkdir(parents=True, exist_ok=True)
+        self.upload_cache = upload_cache
+        self.pandoc_server = pandoc_server
+        self.attachment_cache = attachment_cache
+        self.pandoc_cache = pandoc_cache
+        self.storage_cache = storage_cache
+        self.page_state = page_state
+        self.hash_cache = hash_cache
+        # intermediate HTML is saved for debugging and for checking test runs
+        self.save_debug_files = debug or self.config['test_run']
 
         self.page = None
         set_up_logger(logger)
 
-    def upload(self, content: str):
+    def prepare_source(self, content: str) -> str:
+        '''Prepare md source to be converted to HTML'''
+        if self.config.get('nohead'):
+            return crop_title(content)
+        return content
+
+    def is_cached(self, content: str, version: int or None = None) -> bool:
+        '''
+        Check if the page was uploaded from the same md source `content` with
+        the same options by one of the previous builds. If `version` is specified,
+        the page must also not have been changed on the server since.
+        '''
+        if self.upload_cache is None or self.config['test_run']:
+            return False
+        return self.upload_cache.check(self._cache_key(),
+                                       self._signature(content),
+                                       version)
+
+    def _cache_key(self) -> str:
+        if 'id' in self.config:
+            return str(self.config['id'])
+        return f'{self.config.get("space_key")}/{self.config.get("title")}'
+
+    def _signature(self, content: str) -> str:
+        options = json.dumps(self.config.options, sort_keys=True, default=str)
+        return hashlib.sha256((content + options).encode()).hexdigest()
+
+    def upload(self,
+               content: str,
+               editor_content: str or None = None,
+               source_path: PosixPath or None = None):
+        '''
+        Convert md source `content` and upload it to Confluence. If the source was
+        already converted to HTML (e.g. by md_to_editor_batch), `editor_content`
+        is used instead of converting it again. If `content` is stored in a file,
+        `source_path` may be specified to let Pandoc read the file directly.
+        '''
         title = self.config.get('title')
-        parent_id = self._get_parent_id()
+        parent_id = self.get_parent_id()
 
         self.page = Page(self.con,
                          self.config.get('space_key'),
                          title,
                          parent_id,
-                         self.config.get('id'))
+                         self.config.get('id'),
+                         self.page_cache)
 
-        new_content = content
-        if self.config.get('nohead'):
-            new_content = crop_title(new_content)
-        new_content = md_to_editor(new_content, self.cachedir, self.config['pandoc_path'])
+        if self.page.exists and self.is_cached(content, self.page.version):
+            self.logger.debug(f'Page with id {self.page.id} and title "{self.page.title}"'
+                              ' was uploaded from the same source before. Skipping.')
+            return self._format_result(False)
+
+        if editor_content is None:
+            source = self.prepare_source(content)
+            new_content = md_to_editor(source,
+                                       pandoc_path=self.config['pandoc_path'],
+                                       source_path=source_path if source is content else None,
+                                       server=self.pandoc_server,
+                                       cache=self.pandoc_cache)
+        else:
+            new_content = editor_content
+        self._save_debug_file('1_editor.html', new_content)
 
         self.logger.debug('Converting HTML to Confluence storage format')
-        new_content = editor_to_storage(self.con, new_content)
-        with open(self.cachedir / '2_storage.html', 'w') as f:
-            f.write(new_content)
+        new_content = editor_to_storage(self.con, new_content, self.storage_cache)
+        self._save_debug_file('2_storage.html', new_content)
         new_content = process_images(new_content,
                                      self.md_file_path.parent,
                                      self.attachment_manager)
@@ -118,16 +216,12 @@ class PageUploader:
             #     attachments.append(att_path)
 
         if not self.config['test_run']:
-            self.page.update_attachments(
-                self.attachment_manager.attachments,
-                self.cachedir / REMOTE_ATTACHMENTS_DIR_NAME
-            )
+            self._update_attachments()
 
         if self.config['toc']:
             new_content = add_toc(new_content)
 
-        with open(self.cachedir / '3_unescaped_with_images.html', 'w') as f:
-            f.write(new_content)
+        self._save_debug_file('3_unescaped_with_images.html', new_content)
 
         if self.config['restore_comments']:
             new_content = add_comments(self.page,
@@ -136,12 +230,18 @@ class PageUploader:
 
         if self.config['cloud']:
             new_content = unformat(new_content)
-        need_update = self.page.need_update(new_content, title)
-        with open(self.cachedir / '4_to_upload.html', 'w') as f:
-            f.write(new_content)
+        content_hash = hashlib.sha256(new_content.encode()).hexdigest()
+        page_title = title or self.page.title
+        if self.page.exists and self.page_state is not None and \
+                self.page_state.check(self.page.id, self.page.version, page_title, content_hash):
+            # the page had not changed since it was uploaded by a previous build,
+            # no need to request its properties to compare hashes
+            need_update = False
+        else:
+            need_update = self.page.need_update(new_content, page_title)
+        self._save_debug_file('4_to_upload.html', new_content)
         if need_update:
-            self.logger.debug('Ready to upload. Content saved for debugging to '
-                              f'{self.cachedir / "to_upload.html"}')
+            self.logger.debug('Ready to upload')
             minor_edit = not self.config['notify_watchers']
             if not self.config['test_run']:
                 self.page.upload_content(new_content, title, minor_edit)
@@ -149,16 +249,25 @@ class PageUploader:
             self.logger.debug(f'Page with id {self.page.id} and title "{self.page.title}"'
                               " hadn't changed. Skipping.")
 
+        if self.page_state is not None and not self.config['test_run']:
+            self.page_state.put(self.page.id, self.page.version, self.page.title, content_hash)
+
+        if self.upload_cache is not None and not self.config['test_run']:
+            self.upload_cache.put(self._cache_key(),
+                                  self._signature(content),
+                                  self.page.version,
+                                  list(self.attachment_manager.registry))
+
         self.backup_debug_info()
 
-        if self.config['test_run']:
-            return 'TEST RUN ' + ("* " * need_update) + '{url} ({title})'\
-                .format(url=self.page.url, title=self.page.title)
-        else:
-            return ("* " * need_update) + '{url} ({title})'\
-                .format(url=self.page.url, title=self.page.title)
+        return self._format_result(need_update)
 
-    def _get_parent_id(self):
+    def _format_result(self, need_update: bool) -> str:
+        prefix = 'TEST RUN ' if self.config['test_run'] else ''
+        mark = '* ' if need_update else ''
+        return f'{prefix}{mark}{self.page.url} ({self.page.title})'
+
+    def get_parent_id(self):
         parent_id = None
         if 'id' not in self.config:
             if 'parent_id' in self.config:
@@ -175,6 +284,31 @@ class PageUploader:
                 self.logger.debug(f'Found parent id: {parent_id}')
         return parent_id
 
+    def _update_attachments(self):
+        '''
+        Upload changed attachments to the page. Hashes of the original files
+        are taken from the hash cache, if they had not changed since.
+        '''
+        # several original files may share one copy
+        originals = {path: original for original, path in self.attachment_manager.registry.items()}
+        hashes = {}
+        if self.hash_cache is not None:
+            for path, original in originals.items():
+                _hash = self.hash_cache.get(original)
+                if _hash is not None:
+                    hashes[path.name] = _hash
+        known = set(hashes)
+        self.page.update_attachments(
+            self.attachment_manager.attachments,
+            self.workdir / REMOTE_ATTACHMENTS_DIR_NAME,
+            self.attachment_cache,
+            hashes
+        )
+        if self.hash_cache is not None:
+            self.hash_cache.put({original: hashes[path.name]
+                                 for path, original in originals.items()
+                                 if path.name in hashes and path.name not in known})
+
     def confluence_unescape(self, source: str, attachment_manager: AttachmentManager) -> str:
         '''
         Unescape bits of raw confluene code, escaped by confluence_final preprocessor.
@@ -184,20 +318,10 @@ class PageUploader:
 
         Returns a modified source string with all escaped raw confluence code restored.
         '''
-        def _sub(match):
-            filename = match.group('hash')
-            self.logger.debug(f'Restoring escaped confluence code with hash {filename}')
-            filepath = Path(escape_dir) / filename
-            with open(filepath) as f:
-                escaped_content = f.read()
-                result = self.post_process_escaped_content(escaped_content, attachment_manager)
-                # attachments.extend(new_attachments)
-                return result.rstrip(os.linesep)
-        # attachments = []
-        escape_dir = self.cachedir / ESCAPE_DIR_NAME
-        self.logger.warning(f'PageUploader confluence_unescape {escape_dir}')
-        pattern = re.compile(r"\[confluence_escaped[ \n\r]+hash=\%(?P<hash>.+?)\%\]")
-        return pattern.sub(_sub, source)
+        def _post_process(escaped_content):
+            return self.post_process_escaped_content(escaped_content, attachment_manager)
+
+        return confluence_unescape(source, self.cachedir / ESCAPE_DIR_NAME, _post_process)
 
     def post_process_escaped_content(self, escaped_content: str, attachment_manager: AttachmentManager):
         if escaped_content.lstrip().startswith('<ac:image'):
@@ -211,14 +335,25 @@ class PageUploader:
         else:
             return escaped_content
 
-    def backup_debug_info(self):
-        '''Copy debug files from the cachedir to debug dir'''
-        _, _, files = next(os.walk(self.cachedir))
-        for file in files:
-            new_name = unique_name(self.debug_dir, file)
-            shutil.move(self.cachedir / file, self.debug_dir / new_name)
-
+    def _save_debug_file(self, name: str, content: str):
+        if self.save_debug_files:
+            (self.workdir / name).write_bytes(content.encode('utf8'))
 
+    def backup_debug_info(self):
+        '''Move debug files from the workdir to debug dir'''
+        self.debug_dir.mkdir(parents=True, exist_ok=True)
+        with os.scandir(self.workdir) as entries:
+            files = [entry for entry in entries if entry.is_file()]
+        taken = set(os.listdir(self.debug_dir))
+        for entry in files:
+            new_path = self.debug_dir / unique_name(self.debug_dir, entry.name, taken)
+            try:
+                os.replace(entry.path, new_path)
+            except OSError:  # debug dir is on another file system
+                shutil.move(entry.path, new_path)
+
+
+@lru_cache(maxsize=256)
 def get_content_id_by_title(con: Confluence,
                             title: str,
                             space_key: str,
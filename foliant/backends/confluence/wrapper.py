@@ -3,7 +3,9 @@
 import os
 import shutil
 
+from concurrent.futures import ThreadPoolExecutor
 from filecmp import cmp
+from functools import lru_cache
 from hashlib import md5
 from logging import getLogger
 from pathlib import Path
@@ -12,9 +14,19 @@ from urllib.parse import urlparse
 
 from atlassian import Confluence
 from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
+from .cache import AttachmentCache
+from .cache import PageCache
+from .cache import file_hash
 from .extracter import extract
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 logger = getLogger('flt.confluence.wrapper')
 
 
@@ -36,27 +48,298 @@ class HTMLResponseError(Exception):
 
 HASH_PROPERTY_KEY = 'foliant_hash'
 
+MACRO = ('<ac:structured-macro ac:macro-id="0" ac:name="anchor" '
+         'ac:schema-version="1"><ac:parameter ac:name="">{name}'
+         '</ac:parameter></ac:structured-macro>')
+FOLIANT_START = MACRO.format(name='foliant_start')
+FOLIANT_END = MACRO.format(name='foliant_end')
+
+# comments are requested together with the page version. Unlike the body, they
+# may change without changing the version, so they are never cached
+COMMENTS_EXPAND = ('children.comment.extensions.resolution,'
+                   'children.comment.extensions.inlineProperties')
+
+# max number of simultaneous requests for attachment operations
+MAX_WORKERS = 16
+# uploads are heavier, so fewer of them run at once
+UPLOAD_WORKERS = 8
+
+# size of the HTTP connection pool, must not be less than the number of workers
+POOL_SIZE = 32
+# rate limiting and gateway errors after which idempotent requests are retried,
+# Retry-After header of the response is respected
+RETRY_STATUSES = (429, 502, 503, 504)
+
+# size of chunks in which attachments are written to disk while downloading
+DOWNLOAD_CHUNK_SIZE = 1 << 16
+# uploaded attachments get the hash of their content in the comment, so that
+# unchanged attachments are recognized without downloading them
+ATTACHMENT_HASH_PREFIX = 'foliant-sha256:'
+
+# max number of pages requested in one search query
+BULK_LIMIT = 50
+
+
+def _bad_response(res) -> bool:
+    '''Check whether `res` is an error response from the Confluence API'''
+    return isinstance(res, str) or (isinstance(res, dict) and 'statusCode' in res)
+
+
+def _ok(status_code: int) -> bool:
+    '''Check whether HTTP status code means success'''
+    return 200 <= status_code < 300
+
+
+def _map(func, items: list, max_workers: int) -> list:
+    '''
+    Call `func` for each of `items` in a thread pool of up to `max_workers`
+    threads. A single item is processed in the current thread.
+    Return the list of results in the order of `items`.
+    '''
+    if len(items) <= 1:
+        return list(map(func, items))
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(func, items))
+
+
+def _get_session(con: Confluence):
+    '''Return the requests session of the connection'''
+    # the attribute was renamed in some versions of atlassian-python-api
+    session = getattr(con, '_session', None)
+    return session if session is not None else con.session
+
+
+def configure_session(con: Confluence, pool_size: int = POOL_SIZE):
+    '''
+    Mount an HTTP adapter with a large connection pool on the connection's
+    session, so that all requests, including parallel ones, reuse keep-alive
+    connections. Failed connections and idempotent requests which got a
+    gateway error or were rate limited are retried. Each connection is
+    configured only once.
+
+    `pool_size` should be not less than the max number of simultaneous requests.
+    '''
+    if getattr(con, '_pool_configured', False):
+        return
+    retry = Retry(total=3,
+                  backoff_factor=0.3,
+                  status_forcelist=RETRY_STATUSES,
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size,
+                          max_retries=retry)
+    session = _get_session(con)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Connection'] = 'keep-alive'
+    if orjson is not None:
+        session.hooks['response'].append(_orjson_hook)
+    con._pool_configured = True
+
+
+def _orjson_hook(response, *args, **kwargs):
+    '''Make the response parse its JSON body with orjson, which is much faster'''
+    response.json = lambda **_: orjson.loads(response.content)
+    return response
+
+
+@lru_cache(maxsize=64)
+def _check_space(con: Confluence, space_key: str) -> bool:
+    '''
+    Check that space exists and is accessible, raise exception if not.
+    Only successful checks are cached.
+    '''
+    space = con.get_space(space_key)
+    if isinstance(space, str):
+        if space.startswith('No space found'):
+            raise SpaceNotFoundError(f'Space with key "{space_key}" does not exist'
+                                     f' or you have insufficient privileges:\n'
+                                     f'{space}')
+        else:
+            raise HTMLResponseError(f'Cannot get space with key "{space_key}":\n'
+                                    f'{space}')
+    return True
+
+
+@lru_cache(maxsize=64)
+def _check_parent(con: Confluence, parent_id: int or str) -> bool:
+    '''
+    Check that parent page exists and is accessible, raise exception if not.
+    Only successful checks are cached.
+    '''
+    p = con.get_page_by_id(parent_id)
+    if _bad_response(p):
+        raise PageNotFoundError(f'Cannot access parent page with id {parent_id}:'
+                                f'\n{p}')
+    return True
+
+
+def _cql_escape(value: str) -> str:
+    '''Escape a string to be used inside double quotes in CQL query'''
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _search_pages(connection: Confluence,
+                  space: str,
+                  titles: list,
+                  extra_expand: str = ''):
+    '''
+    Search pages in the `space` by `titles` with one CQL request per BULK_LIMIT
+    titles. Yield contents of the pages found with storage-format body,
+    version and comments expanded.
+    '''
+    titles = list(titles)
+    for i in range(0, len(titles), BULK_LIMIT):
+        chunk = titles[i:i + BULK_LIMIT]
+        quoted = ', '.join(f'"{_cql_escape(t)}"' for t in chunk)
+        cql = f'space="{_cql_escape(space)}" AND type=page AND title in ({quoted})'
+        yield from _search_content(connection, cql, len(chunk), extra_expand)
+
+
+def _search_pages_by_ids(connection: Confluence, ids: list):
+    '''
+    Search pages by their `ids` with one CQL request per BULK_LIMIT ids.
+    Yield contents of the pages found with storage-format body, version and
+    comments expanded.
+    '''
+    # ids are inserted into the query as is, so only numeric ones are searched
+    ids = [str(id_) for id_ in ids if str(id_).isdigit()]
+    for i in range(0, len(ids), BULK_LIMIT):
+        chunk = ids[i:i + BULK_LIMIT]
+        cql = f'type=page AND id in ({", ".join(chunk)})'
+        yield from _search_content(connection, cql, len(chunk))
+
+
+def _search_content(connection: Confluence, cql: str, limit: int, extra_expand: str = '') -> list:
+    expand = 'body.storage,version,' + COMMENTS_EXPAND
+    if extra_expand:
+        expand += ',' + extra_expand
+    results = []
+    start = 0
+    # the server may return fewer results than requested, the rest are
+    # requested until there's no next page
+    while True:
+        res = connection.get('rest/api/content/search',
+                             params={'cql': cql,
+                                     'expand': expand,
+                                     'start': start,
+                                     'limit': limit})
+        if _bad_response(res):
+            raise HTMLResponseError(f'Cannot search pages with query {cql}:\n{res}')
+        page = res.get('results', [])
+        # unlike content requested by id, search results don't contain the base URL
+        base = res.get('_links', {}).get('base')
+        if base:
+            for content in page:
+                content.setdefault('_links', {}).setdefault('base', base)
+        results.extend(page)
+        if 'next' not in res.get('_links', {}) or not page:
+            return results
+        start += len(page)
+
+
+# process-wide cache, used when no cache is supplied to the Page
+default_page_cache = PageCache()
+
 
 class Page:
+    __slots__ = ('_con', '_cache', 'space', 'parent_id', 'title', 'id', '_content',
+                 '_body', '_before', '_after', '_version', '_url', '_properties',
+                 '_last_hash', '_children_comments', '_prefetched_page')
+
+    # pages requested by Page.prefetch: {(space, parent_id): {title: content}}
+    _prefetched = {}
+    _prefetched_by_id = {}
+
     def __init__(self,
                  connection: Confluence,
                  space: str or None = None,
                  title: str or None = None,
                  parent_id: int or None = None,
-                 id_: int or None = None):
-        self._con = connection
-        self._space = space
-        self._parent_id = parent_id
+                 id_: int or None = None,
+                 cache: PageCache or None = None):
         if (title is None or space is None) and id_ is None:
             raise RuntimeError('Must specify either title&space or id of the article')
-        self._title = title
-        self._id = id_
-        self._check_params()
+        self._con = connection
+        configure_session(self._con)
+        self._cache = cache or default_page_cache
+        self.space = space
+        self.parent_id = parent_id
+        self.title = title
+        self.id = id_
 
         self._url = None
+        self._version = None
         self._properties = {}
+        self._last_hash = None
+        self._children_comments = []
+        self._prefetched_page = None
+        self._check_params()
         self._get_info()
 
+    @classmethod
+    def bulk_load(cls,
+                  connection: Confluence,
+                  space: str,
+                  titles: list,
+                  cache: PageCache or None = None) -> dict:
+        '''
+        Load several pages from the `space` by their `titles` with one CQL search
+        request per BULK_LIMIT titles instead of two requests per page.
+
+        Return a dictionary with key = page title, value = Page object.
+        Pages which were not found are not included.
+        '''
+        result = {}
+        for content in _search_pages(connection, space, titles):
+            # the page takes the found content instead of requesting it by id
+            cls._prefetched_by_id[str(content['id'])] = content
+            page = cls(connection, id_=content['id'], cache=cache)
+            page.space = space
+            result[page.title] = page
+        return result
+
+    @classmethod
+    def prefetch(cls,
+                 connection: Confluence,
+                 space: str,
+                 parent_id: int or None,
+                 titles: list):
+        '''
+        Request pages from the `space` by their `titles` with one CQL search
+        request per BULK_LIMIT titles and remember them. Pages with these titles,
+        created afterwards with the same space and parent_id, take their content
+        from the prefetched data and skip space and parent checks when possible.
+        Each prefetched page is used only once.
+
+        Only pages which were found are remembered: search index may lag behind
+        recent changes, so pages which were not found are requested by title.
+        '''
+        found = {content['title']: content
+                 for content in _search_pages(connection, space, titles, extra_expand='ancestors')}
+        cls._prefetched.setdefault((space, parent_id), {}).update(found)
+
+    @classmethod
+    def prefetch_by_ids(cls, connection: Confluence, ids: list):
+        '''
+        Request pages by their `ids` with one CQL search request per BULK_LIMIT
+        ids and remember them. Pages with these ids, created afterwards, take
+        their content from the prefetched data. Each prefetched page is used
+        only once.
+        '''
+        for content in _search_pages_by_ids(connection, ids):
+            cls._prefetched_by_id[str(content['id'])] = content
+
+    @classmethod
+    def clear_prefetched(cls):
+        '''Forget all prefetched pages which were not used'''
+        cls._prefetched.clear()
+        cls._prefetched_by_id.clear()
+
+    def _pop_prefetched(self) -> dict or None:
+        '''Return prefetched content of this page or None if it wasn't prefetched'''
+        return self._prefetched.get((self.space, self.parent_id), {}).pop(self.title, None)
+
     def _check_params(self):
         '''
         Check param values:
@@ -66,34 +349,19 @@ class Page:
         if self.id:
             # if id is stated, space and parent_id are ignored, no need to check
             return
-        if self.space:
-            space = self._con.get_space(self.space)
-            if isinstance(space, str):
-                if space.startswith('No space found'):
-                    raise SpaceNotFoundError(f'Space with key "{self.space}" does not exist'
-                                             f' or you have insufficient privileges:\n'
-                                             f'{space}')
-                else:
-                    raise HTMLResponseError(f'Cannot get space with key "{self.space}":\n'
-                                            f'{space}')
+        self._prefetched_page = content = self._pop_prefetched()
+        # space and parent are proven to exist if the page was found in them
+        if self.space and not content:
+            _check_space(self._con, self.space)
         if self.parent_id:
-            p = self._con.get_page_by_id(self.parent_id)
-            if isinstance(p, str) or 'statusCode' in p:
-                raise PageNotFoundError(f'Cannot access parent page with id {self.parent_id}:'
-                                        f'\n{p}')
+            ancestors = content.get('ancestors', []) if content else []
+            if str(self.parent_id) not in (str(a['id']) for a in ancestors):
+                _check_parent(self._con, self.parent_id)
 
     @property
     def exists(self):
         return self._content is not None
 
-    @property
-    def title(self):
-        return self._title
-
-    @property
-    def space(self):
-        return self._space
-
     @property
     def version(self):
         return self._version
@@ -110,20 +378,16 @@ class Page:
     def full_body(self):
         return self._before + self.body + self._after
 
-    @property
-    def id(self):
-        return self._id
-
-    @property
-    def parent_id(self):
-        return self._parent_id
-
     @property
     def url(self):
         return self._url
 
     @property
     def properties(self):
+        if self._properties is None:
+            self._properties = {}
+            for pp in self._con.get_page_properties(self.id).get('results', []):
+                self._properties[pp['key']] = pp['value']
         return self._properties
 
     def generate_new_body(self, new_content: str) -> str:
@@ -132,76 +396,147 @@ class Page:
         content from the page, and opening/closing foliant tags.
         # If there was no static content — just return the `new_content`.
         '''
-        MACRO = ('<ac:structured-macro ac:macro-id="0" ac:name="anchor" '
-                 'ac:schema-version="1"><ac:parameter ac:name="">{name}'
-                 '</ac:parameter></ac:structured-macro>')
-        # if self._before or self._after:
-        result = self._before + MACRO.format(name="foliant_start")
-        result += new_content + MACRO.format(name="foliant_end") + self._after
-        # else:
-            # result = new_content
-        return result
+        return ''.join((self._before, FOLIANT_START, new_content, FOLIANT_END, self._after))
 
     def _get_info(self):
-        if self._id:
+        if self.id:
             # ID supplied. Trying to get page by ID
+            page = self._prefetched_by_id.pop(str(self.id), None)
+            if page:
+                cached = self._cache.get(page['id'], page['version']['number'])
+                self._update_properties(page, cached[1] if cached else None)
+                self._set_comments(page)
+                return
 
-            page = self._con.get_page_by_id(self._id, expand='body.storage')
-            if isinstance(page, str) or 'statusCode' in page:
+            page = self._con.get_page_by_id(self.id, expand='version,' + COMMENTS_EXPAND)
+            if _bad_response(page):
                 raise PageNotFoundError(f'Cannot access page with id {self.parent_id}:'
                                         f'\n{page}')
-            self._update_properties(page)
+            self._update_properties(*self._load_content(page))
+            self._set_comments(page)
         else:
             # Page is defined by space and title. Searching for it:
-            page = self._con.get_page_by_title(self._space, self._title)
+            page = self._prefetched_page
+            if page:
+                self._update_properties(page)
+                self._set_comments(page)
+                return
+            page = self._con.get_page_by_title(self.space,
+                                               self.title,
+                                               expand='body.storage,version,' + COMMENTS_EXPAND)
             if page:
-                page = self._con.get_page_by_id(page['id'], expand='body.storage')
                 self._update_properties(page)
+                self._set_comments(page)
             else:
-                self._content = self._id = None
+                self._content = self.id = None
                 self._before = self._after = self._body = ''
 
-    def _update_properties(self, content: dict):
+    def _set_comments(self, page: dict):
+        self._children_comments = page.get('children', {}).get('comment', {}).get('results', [])
+
+    def _load_content(self, page: dict) -> tuple:
+        '''
+        Get page content with storage-format body for the `page`, which must
+        contain the version info. Body is only requested from the server if
+        this version of the page is not cached.
+
+        Return a tuple (content, parts), where parts are the extracted body
+        parts if they were cached, or None.
+        '''
+        cached = self._cache.get(page['id'], page['version']['number'])
+        if cached is not None:
+            return cached
+        content = self._con.get_page_by_id(page['id'], expand='body.storage,version')
+        if _bad_response(content):
+            raise PageNotFoundError(f'Cannot access page with id {page["id"]}:'
+                                    f'\n{content}')
+        return content, None
+
+    def _update_properties(self,
+                           content: dict,
+                           parts: tuple or None = None,
+                           load_properties: bool = True):
         self._content = content
-        self._id = content['id']
-        self._before, self._body, self._after = extract(content['body']['storage']['value'])
-        for pp in self._con.get_page_properties(self._id).get('results', []):
-            self._properties[pp['key']] = pp['value']
+        self.id = content['id']
+        if parts is None:
+            parts = extract(content['body']['storage']['value'])
+            if 'version' in content:
+                self._cache.put(content, parts)
+        self._before, self._body, self._after = parts
+        if 'version' in content:
+            self._version = content['version']['number']
+        if load_properties:
+            # page properties are requested on first use
+            self._properties = None
         if '_links' in self._content:
             self._url = self._content['_links']['base'] + self._content['_links']['webui']
         if self.title is None:
-            self._title = content['title']
+            self.title = content['title']
 
     def _calculate_hash(self, content: str, title: str) -> str:
+        # need_update and update_hash are called with the same content in a row,
+        # remember the last result to avoid hashing the page twice
+        if self._last_hash and self._last_hash[:2] == (content, title):
+            return self._last_hash[2]
         _hash = md5(content.encode())
         _hash.update(title.encode())
-        return _hash.hexdigest()
+        result = _hash.hexdigest()
+        self._last_hash = (content, title, result)
+        return result
 
-    def download_all_attachments(self, dest: PosixPath or str) -> dict:
+    def get_attachments(self) -> list:
+        '''Return the list of all attachments of the page with their versions'''
+        if not self.exists:
+            return []
+        result = []
+        start = 0
+        while True:
+            res = self._con.get_attachments_from_content(self.id,
+                                                         start=start,
+                                                         limit=BULK_LIMIT,
+                                                         expand='version,metadata')
+            result.extend(res['results'])
+            if 'next' not in res.get('_links', {}) or not res['results']:
+                return result
+            start += len(res['results'])
+
+    def download_attachments(self, attachments: list, dest: PosixPath or str) -> dict:
         '''
-        Download all attachments into the `dest` dir. Return a dictionary
-        with key = downloaded attachment filename; value = (its id, full path).
+        Download `attachments` (as returned by get_attachments) into the `dest`
+        dir. Return a dictionary with key = downloaded attachment filename;
+        value = (its id, full path).
         '''
-        if not self.exists:
-            return {}
-
-        result = {}
-        atts = self._con.get_attachments_from_content(self.id)
-        # base = atts['_links']['base']
-        for att in atts['results']:
+        def _download_one(att: dict) -> tuple or None:
             try:
                 url = att['_links']['download'] + '&download=true'
                 filename = os.path.basename(urlparse(url).path)
                 filepath = (Path(dest) / filename).resolve()
-                r = self._con.request(path=url)
             except KeyError:
-                continue
-            if r.status_code != 200:
-                continue
-            with open(filepath, 'wb') as f:
-                f.write(r.content)
-            result[filename] = (att['id'], filepath)
-        return result
+                return None
+            # stream the response to avoid keeping whole attachment in memory
+            session = _get_session(self._con)
+            with session.get(self._con.url.rstrip('/') + '/' + url.lstrip('/'),
+                             stream=True,
+                             verify=self._con.verify_ssl,
+                             timeout=self._con.timeout) as r:
+                if r.status_code != 200:
+                    return None
+                with open(filepath, 'wb') as f:
+                    for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+            return filename, (att['id'], filepath)
+
+        if not attachments:
+            return {}
+        downloaded = _map(_download_one, attachments, MAX_WORKERS)
+        return dict(d for d in downloaded if d is not None)
+
+    def download_all_attachments(self, dest: PosixPath or str) -> dict:
+        '''
+        Download all attachments into the `dest` dir. Return a dictionary
+        with key = downloaded attachment filename; value = (its id, full path).
+        '''
+        return self.download_attachments(self.get_attachments(), dest)
 
     def delete_attachment(self, att_id: int):
         '''
@@ -211,7 +546,7 @@ class Page:
         if self.exists:
             res = self._con.request(method='DELETE',
                                     path=f'rest/api/content/{att_id}')
-            if str(res.status_code)[0] != '2':
+            if not _ok(res.status_code):
                 raise RuntimeError(f"Can't delete an attachment {att_id} on page {self.id}:"
                                    f"\n{res.text}")
 
@@ -221,51 +556,140 @@ class Page:
         If not — do nothing.
         '''
         if self.exists:
-            attachments = self._con.get_attachments_from_content(self.id)['results']
-            for att in attachments:
-                self.delete_attachment(att['id'])
+            attachments = self.get_attachments()
+            if not attachments:
+                return
+            _map(self.delete_attachment, [att['id'] for att in attachments], MAX_WORKERS)
 
-    def upload_attachment(self, filename: str or PosixPath):
+    def upload_attachment(self, filename: str or PosixPath, comment: str or None = None):
         if not self.exists:
             raise PageNotAssignedError
-        res = self._con.attach_file(filename, page_id=self._id)
-        if isinstance(res, str) or 'statusCode' in res:
+        res = self._con.attach_file(filename, page_id=self.id, comment=comment)
+        if _bad_response(res):
             raise RuntimeError(f'Cannot access page with id {self.parent_id}:'
                                f'\n{res}')
         return res
 
+    def upload_attachments(self, filenames: list, comments: list or None = None) -> list:
+        '''
+        Upload several attachments into the page simultaneously, optionally
+        with `comments` for each of them.
+        Return the list of server responses in the order of `filenames`.
+        '''
+        if not self.exists:
+            raise PageNotAssignedError
+        if not filenames:
+            return []
+        if comments is None:
+            return _map(self.upload_attachment, filenames, UPLOAD_WORKERS)
+        return _map(lambda args: self.upload_attachment(*args),
+                    list(zip(filenames, comments)),
+                    UPLOAD_WORKERS)
+
     def update_attachments(self,
                            attachments: list,
-                           cache_dir: PosixPath or str):
+                           cache_dir: PosixPath or str,
+                           attachment_cache: AttachmentCache or None = None,
+                           hashes: dict or None = None):
         '''
         Upload a list of attachments into page. Only changed attachments will
         be updated. If page doesn't exist yet, an empty one will be created.
 
-        `page` — a Page object to which attachments will be uploaded.
         `attachments` — a list of attachments PosixPaths.
         `cache_dir` — temporary dir where old attachments will be downloaded to
                       for comparison.
+        `attachment_cache` — AttachmentCache with hashes of attachments uploaded
+                             before. Remote attachments which were uploaded from
+                             the same files are not downloaded for comparison.
+        `hashes` — sha256 hashes of the attachments, which are already known, by
+                   attachment name. Hashes calculated here are added to it.
         '''
+        if hashes is None:
+            hashes = {}
         if attachments:
             # we can only upload attachments to existing page
             if not self.exists:
                 logger.debug('Page does not exist. Creating an empty one '
                              'to upload attachments')
                 self.create_empty_page()
-            cache_dir = Path(cache_dir)
-            shutil.rmtree(cache_dir, ignore_errors=True)
-            cache_dir.mkdir(exist_ok=True)
-            remote_dict = self.download_all_attachments(cache_dir)
+            remote = {att['title']: att for att in self.get_attachments()}
+            to_compare = []
+            to_upload = []
             for att in attachments:
-                if att.name in remote_dict:
-                    att_id, att_path = remote_dict[att.name]
-                    if cmp(att, att_path):  # attachment not changed
+                remote_att = remote.get(att.name)
+                if remote_att is None:
+                    to_upload.append(att)
+                    continue
+                # files of different size are surely different
+                remote_size = remote_att.get('extensions', {}).get('fileSize')
+                if remote_size is not None and int(remote_size) != att.stat().st_size:
+                    to_upload.append(att)
+                    continue
+                to_compare.append(att)
+
+            if to_compare:
+                # hashing releases the GIL, so files are hashed in parallel
+                not_hashed = [att for att in to_compare if att.name not in hashes]
+                hashes.update(zip((att.name for att in not_hashed),
+                                  _map(file_hash, not_hashed, MAX_WORKERS)))
+                compared = {att.name for att in to_compare}
+
+                def _unchanged(att) -> bool:
+                    remote_att = remote[att.name]
+                    comment = remote_att.get('metadata', {}).get('comment')
+                    if comment == ATTACHMENT_HASH_PREFIX + hashes[att.name]:
+                        return True
+                    return attachment_cache is not None and \
+                        attachment_cache.check(self.id,
+                                               att.name,
+                                               remote_att['version']['number'],
+                                               hashes[att.name])
+
+                to_compare = [att for att in to_compare if not _unchanged(att)]
+                for att_name in compared - {att.name for att in to_compare}:
+                    logger.debug(f"Attachment {att_name} hadn't changed, skipping")
+
+            if to_compare:
+                cache_dir = Path(cache_dir)
+                shutil.rmtree(cache_dir, ignore_errors=True)
+                cache_dir.mkdir(exist_ok=True)
+                remote_dict = self.download_attachments([remote[att.name] for att in to_compare],
+                                                        cache_dir)
+                downloaded = dict(remote_dict.values())  # id: path
+                unchanged = []
+                for att in to_compare:
+                    att_path = downloaded.get(remote[att.name]['id'])
+                    if att_path and cmp(att, att_path):  # attachment not changed
                         logger.debug(f"Attachment {att.name} hadn't changed, skipping")
+                        unchanged.append(att)
                         continue
+                    to_upload.append(att)
+                if attachment_cache is not None:
+                    attachment_cache.put(self.id,
+                                         [(att.name,
+                                           remote[att.name]['version']['number'],
+                                           hashes[att.name]) for att in unchanged])
+
+            for att in to_upload:
                 logger.debug(f"Attachment {att.name} CHANGED, reuploading")
-                # not sure if it's needed, we can update images without deleting
-                # page.delete_attachment(att_id)
-                self.upload_attachment(att)
+            not_hashed = [att for att in to_upload if att.name not in hashes]
+            if not_hashed:
+                hashes.update(zip((att.name for att in not_hashed),
+                                  _map(file_hash, not_hashed, MAX_WORKERS)))
+            responses = self.upload_attachments(
+                to_upload,
+                [ATTACHMENT_HASH_PREFIX + hashes[att.name] for att in to_upload]
+            )
+            if attachment_cache is not None:
+                uploaded = []
+                for att, res in zip(to_upload, responses):
+                    # new attachments are returned in a list, updated — as is
+                    for remote_att in res.get('results', [res]):
+                        if 'version' in remote_att:
+                            uploaded.append((att.name,
+                                             remote_att['version']['number'],
+                                             hashes[att.name]))
+                attachment_cache.put(self.id, uploaded)
 
     def create_empty_page(self):
         '''Create an empty page'''
@@ -290,53 +714,57 @@ class Page:
                        new_content: str,
                        title: str = None,
                        minor_edit: bool = True):
+        # the same title is used for the hash, which is checked and stored
+        title = title or self.title
+        if self.exists and not self.need_update(new_content, title):
+            logger.debug(f'Content of the page {self.id} has not changed, skipping update')
+            return self._content
         body = self.generate_new_body(new_content)
         if self.exists:
-            content = self._con.update_page(page_id=self._id,
+            content = self._con.update_page(page_id=self.id,
                                             body=body,
-                                            title=title or self.title,
+                                            title=title,
                                             minor_edit=minor_edit)
         else:
             logger
             logger.debug(f'''create_page(type='page',
-                                         title={title or self.title},
-                                         space={self._space},
+                                         title={title},
+                                         space={self.space},
                                          body={body[:100]}...,
                                          parent_id={self.parent_id},
                                          representation='storage')' ''')
             content = self._con.create_page(type='page',
-                                            title=title or self.title,
-                                            space=self._space,
+                                            title=title,
+                                            space=self.space,
                                             body=body,
                                             parent_id=self.parent_id,
                                             representation='storage')
-        if isinstance(content, str) or 'statusCode' in content:
+        if _bad_response(content):
             raise RuntimeError(f"Can't create or update page:\n {content}")
-        self._update_properties(content)
+        # properties are not changed by the update and a new page has none,
+        # so there's no need to request them again
+        self._update_properties(content, load_properties=False)
         self.update_hash(new_content, title)
 
         return content
 
     def update_hash(self, content: str, title: str) -> dict:
         if HASH_PROPERTY_KEY in self.properties:
-            self._con.delete_page_property(self._id, HASH_PROPERTY_KEY)
+            self._con.delete_page_property(self.id, HASH_PROPERTY_KEY)
         data = {
             'key': HASH_PROPERTY_KEY,
             'value': self._calculate_hash(content, title)
         }
-        result = self._con.set_page_property(self._id, data)
-        if isinstance(result, str) or 'statusCode' in result:
+        result = self._con.set_page_property(self.id, data)
+        if _bad_response(result):
             raise RuntimeError(f"Can't update page property:\n {result}")
         self._properties[HASH_PROPERTY_KEY] = data['value']
 
-    def get_resolved_comment_ids(self) -> list:
+    def get_resolved_comment_ids(self) -> set:
         if not self.exists:
-            return []
-        resolved_ids = set()
-        res = self._con.get_page_by_id(self.id, expand='children.comment.extensions.resolution,children.comment.extensions.inlineProperties')
-        for comment in res['children']['comment']['results']:
-            if 'inlineProperties' not in comment['extensions']:
-                continue  # it's a regular comment
-            if comment['extensions']['resolution']['status'] == 'resolved':
-                resolved_ids.update((comment['extensions']['inlineProperties']['markerRef'],))
-        return resolved_ids
+            return set()
+        return {comment['extensions']['inlineProperties']['markerRef']
+                for comment in self._children_comments
+                # regular comments don't have inlineProperties
+                if 'inlineProperties' in comment['extensions']
+                and comment['extensions']['resolution']['status'] == 'resolved'}
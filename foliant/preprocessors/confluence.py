@@ -7,8 +7,8 @@ import yaml
 from getpass import getpass
 from pathlib import Path
 from pathlib import PosixPath
+from subprocess import CalledProcessError
 from subprocess import PIPE
-from subprocess import STDOUT
 from subprocess import run
 
 from atlassian import Confluence
@@ -20,10 +20,14 @@ from foliant.preprocessors.confluence_final.process import SYNTAX_CONVERT
 from foliant.preprocessors.utils.preprocessor_ext import BasePreprocessorExt
 from foliant.utils import output
 
+from foliant.backends.confluence.cache import PageCache
+from foliant.backends.confluence.constants import PAGE_CACHE_DIR_NAME
 from foliant.backends.confluence.wrapper import Page
 
 IMG_DIR = '_confluence_attachments'
 DEBUG_FILENAME = 'import_debug.html'
+# names of Confluence tags, which are removed from imported content
+AC_TAG_RE = re.compile('ac:')
 
 
 def process(page: Page, filename: str or PosixPath) -> str:
@@ -50,7 +54,7 @@ def download_images(page: Page, filename: str or PosixPath) -> BeautifulSoup:
         img_dir.mkdir()
     page.download_all_attachments(img_dir)
     soup = BeautifulSoup(page.body, 'html.parser')
-    for img in soup.find_all(re.compile('ac:image')):
+    for img in soup.find_all('ac:image'):
         title = img.attrs.get('ac:title', '')
         child = next(img.children)
         if child.name == 'ri:attachment':
@@ -74,9 +78,8 @@ def cleanup(source: BeautifulSoup) -> str:
 def unwrap_tags(source: BeautifulSoup) -> BeautifulSoup:
     tags_to_unwrap = ['ac:inline-comment-marker', 'span']
 
-    for tag_name in tags_to_unwrap:
-        for tag in source.find_all(re.compile(tag_name)):
-            tag.unwrap()
+    for tag in source.find_all(tags_to_unwrap):
+        tag.unwrap()
     return source
 
 
@@ -89,7 +92,7 @@ def transform_code_blocks(source: BeautifulSoup) -> BeautifulSoup:
     lang_dict = {v: k for k, v in SYNTAX_CONVERT.items()}
 
     for tag in source.find_all(
-        re.compile('ac:structured-macro'),
+        'ac:structured-macro',
         attrs={'ac:name': "code"}
     ):
         lang = ''
@@ -116,10 +119,8 @@ def remove_tags(source: BeautifulSoup) -> BeautifulSoup:
 
     :returns: string with confluence tags removed.
     '''
-    tags_to_remove = ['ac:.*']
-    for tag_name in tags_to_remove:
-        for tag in source.find_all(re.compile(tag_name)):
-            tag.decompose()
+    for tag in source.find_all(AC_TAG_RE):
+        tag.decompose()
     return source
 
 
@@ -215,11 +216,14 @@ class Preprocessor(BasePreprocessorExt):
         self._connect(host,
                       *credentials,
                       config['verify_ssl'])
+        page_cache_dir = cachedir / PAGE_CACHE_DIR_NAME
+        page_cache_dir.mkdir(exist_ok=True)
         page = Page(self.con,
                     config.get('space_key'),
                     config.get('title'),
                     None,
-                    config.get('id'))
+                    config.get('id'),
+                    PageCache(page_cache_dir / 'pages'))
         body = process(page, self.current_filepath)
         debug_filepath = cachedir / DEBUG_FILENAME
         with open(debug_filepath, 'w') as f:
@@ -230,10 +234,15 @@ class Preprocessor(BasePreprocessorExt):
                              source_path: str or PosixPath,
                              pandoc_path: str = 'pandoc') -> str:
         '''Convert HTML to Markdown with Pandoc'''
-        command = f'{pandoc_path} -f html -t gfm {source_path}'
-        self.logger.debug('Converting HTML to MD with Pandoc, command:\n' + command)
-        p = run(command, shell=True, check=True, stdout=PIPE, stderr=STDOUT)
-        return p.stdout.decode()
+        command = [pandoc_path, '-f', 'html', '-t', 'gfm', str(source_path)]
+        self.logger.debug('Converting HTML to MD with Pandoc, command:\n' + ' '.join(command))
+        try:
+            p = run(command, check=True, stdout=PIPE, stderr=PIPE)
+        except CalledProcessError as e:
+            self.logger.error('Pandoc failed to convert the page:\n'
+                              f'{e.stderr.decode(errors="replace")}')
+            raise
+        return p.stdout.decode('utf8')
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
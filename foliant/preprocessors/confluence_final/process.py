@@ -31,6 +31,12 @@ FENCE_BLOCKS_RE = re.compile(
 PRE_BLOCKS_RE = re.compile(
     r'(?:^|\n\n)(?P<content>(?:    [^\n]*\n)+)'
 )
+
+# used by _normalize
+LAST_LINE_END_RE = re.compile(r'(?<=\S)$')
+TRAILING_WHITESPACE_RE = re.compile(r'[ \n]+$')
+LINE_END_SPACES_RE = re.compile(r' +\n')
+
 SYNTAX_CONVERT = {
     'python': 'py',
     'actionscript': 'actionscript3',
@@ -110,12 +116,11 @@ def _normalize(markdown_content: str) -> str:
     :returns: Normalized Markdown content
     '''
 
-    markdown_content = re.sub(r'\r\n', '\n', markdown_content)
-    markdown_content = re.sub(r'\r', '\n', markdown_content)
-    markdown_content = re.sub(r'(?<=\S)$', '\n', markdown_content)
-    markdown_content = re.sub(r'\t', '    ', markdown_content)
-    markdown_content = re.sub(r'[ \n]+$', '\n', markdown_content)
-    markdown_content = re.sub(r' +\n', '\n', markdown_content)
+    markdown_content = markdown_content.replace('\r\n', '\n').replace('\r', '\n')
+    markdown_content = LAST_LINE_END_RE.sub('\n', markdown_content)
+    markdown_content = markdown_content.replace('\t', '    ')
+    markdown_content = TRAILING_WHITESPACE_RE.sub('\n', markdown_content)
+    markdown_content = LINE_END_SPACES_RE.sub('\n', markdown_content)
 
     return markdown_content
 
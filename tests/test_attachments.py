@@ -0,0 +1,141 @@
+import logging
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import MagicMock
+from unittest.mock import Mock
+
+from foliant.backends.confluence.cache import AttachmentCache
+from foliant.backends.confluence.cache import PageCache
+from foliant.backends.confluence.cache import file_hash
+from foliant.backends.confluence.convert import set_up_logger
+from foliant.backends.confluence.uploader import AttachmentManager
+from foliant.backends.confluence.wrapper import ATTACHMENT_HASH_PREFIX
+from foliant.backends.confluence.wrapper import Page
+
+
+def remote_attachment(path: Path, comment: str or None = None, size: int or None = None) -> dict:
+    return {'id': f'att_{path.name}',
+            'title': path.name,
+            'version': {'number': 1},
+            'extensions': {'fileSize': path.stat().st_size if size is None else size},
+            'metadata': {'comment': comment} if comment else {},
+            '_links': {'download': f'/download/attachments/1/{path.name}?version=1'}}
+
+
+class TestUpdateAttachments(TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.dir = Path(self.tmp.name)
+        self.con = Mock()
+        self.con.get_page_by_id.return_value = {'id': '1',
+                                                'title': 'Page',
+                                                'version': {'number': 1},
+                                                'body': {'storage': {'value': ''}}}
+        self.con.attach_file.return_value = {'results': [{'version': {'number': 2}}]}
+        self.page = Page(self.con, id_='1', cache=PageCache())
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def make_file(self, name: str, content: bytes) -> Path:
+        path = self.dir / name
+        path.write_bytes(content)
+        return path
+
+    def set_remote(self, *attachments: dict):
+        self.con.get_attachments_from_content.return_value = {'results': list(attachments),
+                                                              '_links': {}}
+
+    def uploaded(self) -> list:
+        return [call.args[0].name for call in self.con.attach_file.call_args_list]
+
+    def test_new_attachment_uploaded(self):
+        path = self.make_file('new.png', b'new')
+        self.set_remote()
+        self.page.update_attachments([path], self.dir / 'remote')
+        self.assertEqual(self.uploaded(), ['new.png'])
+        comment = self.con.attach_file.call_args.kwargs['comment']
+        self.assertEqual(comment, ATTACHMENT_HASH_PREFIX + file_hash(path))
+
+    def test_unchanged_by_hash_comment(self):
+        path = self.make_file('same.png', b'same')
+        self.set_remote(remote_attachment(path, ATTACHMENT_HASH_PREFIX + file_hash(path)))
+        self.page.update_attachments([path], self.dir / 'remote')
+        self.assertEqual(self.uploaded(), [])
+        self.con.get_attachments_from_content.assert_called_once()
+
+    def test_changed_by_size(self):
+        path = self.make_file('changed.png', b'changed')
+        self.set_remote(remote_attachment(path,
+                                          ATTACHMENT_HASH_PREFIX + file_hash(path),
+                                          size=1))
+        self.page.update_attachments([path], self.dir / 'remote')
+        self.assertEqual(self.uploaded(), ['changed.png'])
+
+    def test_changed_by_hash_comment(self):
+        path = self.make_file('changed.png', b'changed')
+        self.set_remote(remote_attachment(path, ATTACHMENT_HASH_PREFIX + 'old'))
+        # remote attachment can't be downloaded for comparison
+        self.con._session = MagicMock()
+        self.con._session.get.return_value.__enter__.return_value.status_code = 404
+        self.con.url = 'https://confluence'
+        self.page.update_attachments([path], self.dir / 'remote')
+        self.assertEqual(self.uploaded(), ['changed.png'])
+
+    def test_unchanged_by_attachment_cache(self):
+        path = self.make_file('cached.png', b'cached')
+        self.set_remote(remote_attachment(path))
+        cache = AttachmentCache(self.dir / 'attachments.json')
+        cache.put('1', [('cached.png', 1, file_hash(path))])
+        self.page.update_attachments([path], self.dir / 'remote', cache)
+        self.assertEqual(self.uploaded(), [])
+
+    def test_known_hashes_used(self):
+        path = self.make_file('known.png', b'known')
+        self.set_remote(remote_attachment(path, ATTACHMENT_HASH_PREFIX + 'known hash'))
+        hashes = {'known.png': 'known hash'}
+        self.page.update_attachments([path], self.dir / 'remote', hashes=hashes)
+        self.assertEqual(self.uploaded(), [])
+
+
+class TestAttachmentManager(TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.dir = Path(self.tmp.name)
+        logger = logging.getLogger('test')
+        # the module logger is set up by PageUploader
+        set_up_logger(logger)
+        self.manager = AttachmentManager(self.dir / 'attachments', logger)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def make_file(self, name: str, content: bytes) -> Path:
+        path = self.dir / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+        return path
+
+    def test_same_file_added_once(self):
+        path = self.make_file('image.png', b'image')
+        self.assertEqual(self.manager.add_attachment(path), self.manager.add_attachment(path))
+        self.assertEqual(len(self.manager.attachments), 1)
+
+    def test_same_content_in_other_dir_shares_copy(self):
+        first = self.manager.add_attachment(self.make_file('a/image.png', b'image'))
+        second = self.manager.add_attachment(self.make_file('b/image.png', b'image'))
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.manager.registry), 2)
+        self.assertEqual(self.manager.attachments, [first])
+
+    def test_different_content_gets_unique_name(self):
+        first = self.manager.add_attachment(self.make_file('a/image.png', b'image'))
+        second = self.manager.add_attachment(self.make_file('b/image.png', b'other'))
+        self.assertNotEqual(first, second)
+        self.assertEqual(len(self.manager.attachments), 2)
+
+    def test_missing_file(self):
+        self.assertIsNone(self.manager.add_attachment(self.dir / 'missing.png'))
+        self.assertEqual(self.manager.attachments, [])
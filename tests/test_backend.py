@@ -0,0 +1,67 @@
+import logging
+
+from types import SimpleNamespace
+from unittest import TestCase
+from unittest.mock import Mock
+from unittest.mock import patch
+
+from foliant.backends.confluence.confluence import Backend
+from foliant.backends.confluence.uploader import BadParamsException
+
+
+def job(parent_error=None, **config) -> tuple:
+    uploader = Mock(config=config)
+    uploader.get_parent_id.return_value = config.get('parent_id')
+    uploader.get_parent_id.side_effect = parent_error
+    return None, uploader, ''
+
+
+class TestUploadWaves(TestCase):
+    def get_waves(self, jobs: list) -> list:
+        # the methods don't use the state of the backend
+        return Backend._get_upload_waves(None, jobs)
+
+    def test_independent_sections(self):
+        jobs = [job(space_key='S', title='A'),
+                job(space_key='S', title='B', parent_title='Existing')]
+        self.assertEqual(self.get_waves(jobs), [[0, 1]])
+
+    def test_parent_uploaded_first(self):
+        jobs = [job(space_key='S', title='Grandchild', parent_title='Child'),
+                job(space_key='S', title='Child', parent_title='Parent'),
+                job(space_key='S', title='Parent'),
+                job(space_key='S', title='Other')]
+        self.assertEqual(self.get_waves(jobs), [[2, 3], [1], [0]])
+
+    def test_parent_in_other_space(self):
+        jobs = [job(space_key='S', title='Child', parent_title='Parent'),
+                job(space_key='T', title='Parent')]
+        self.assertEqual(self.get_waves(jobs), [[0, 1]])
+
+    def test_parent_title_ignored(self):
+        jobs = [job(space_key='S', title='Child', parent_title='Parent', parent_id=1),
+                job(id=2, title='Page', parent_title='Parent'),
+                job(space_key='S', title='Parent')]
+        self.assertEqual(self.get_waves(jobs), [[0, 1, 2]])
+
+    def test_cycle(self):
+        jobs = [job(space_key='S', title='A', parent_title='B'),
+                job(space_key='S', title='B', parent_title='A'),
+                job(space_key='S', title='C')]
+        self.assertEqual(self.get_waves(jobs), [[2], [0, 1]])
+
+
+class TestPrefetchPages(TestCase):
+    def setUp(self):
+        self.backend = SimpleNamespace(con=Mock(), logger=logging.getLogger('test'))
+
+    def test_missing_parent_skipped(self):
+        jobs = [job(space_key='S', title='Parent'),
+                job(space_key='S', title='Child', parent_title='Parent',
+                    parent_error=BadParamsException('Cannot find parent with title Parent')),
+                job(id='10')]
+        with patch('foliant.backends.confluence.wrapper.Page.prefetch') as prefetch, \
+                patch('foliant.backends.confluence.wrapper.Page.prefetch_by_ids') as by_ids:
+            Backend._prefetch_pages(self.backend, jobs)
+        prefetch.assert_called_once_with(self.backend.con, 'S', None, ['Parent'])
+        by_ids.assert_called_once_with(self.backend.con, ['10'])
@@ -0,0 +1,126 @@
+import os
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from foliant.backends.confluence.cache import FileCache
+from foliant.backends.confluence.cache import FileHashCache
+from foliant.backends.confluence.cache import PageStateCache
+from foliant.backends.confluence.cache import UploadCache
+
+
+class CacheTestCase(TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.dir = Path(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+
+class TestUploadCache(CacheTestCase):
+    def setUp(self):
+        super().setUp()
+        self.attachment = self.dir / 'image.png'
+        self.attachment.write_bytes(b'image')
+        self.cache = UploadCache(self.dir / 'uploads.json')
+        self.cache.put('SPACE/Page', 'signature', 3, [self.attachment])
+
+    def test_same_source(self):
+        self.assertTrue(self.cache.check('SPACE/Page', 'signature'))
+        self.assertTrue(self.cache.check('SPACE/Page', 'signature', 3))
+
+    def test_other_page(self):
+        self.assertFalse(self.cache.check('SPACE/Other', 'signature'))
+
+    def test_changed_source(self):
+        self.assertFalse(self.cache.check('SPACE/Page', 'other signature'))
+
+    def test_page_changed_on_server(self):
+        self.assertFalse(self.cache.check('SPACE/Page', 'signature', 4))
+
+    def test_changed_attachment(self):
+        self.attachment.write_bytes(b'changed image')
+        self.assertFalse(self.cache.check('SPACE/Page', 'signature', 3))
+
+    def test_removed_attachment(self):
+        self.attachment.unlink()
+        self.assertFalse(self.cache.check('SPACE/Page', 'signature', 3))
+
+    def test_written_on_flush(self):
+        self.assertFalse(UploadCache(self.dir / 'uploads.json').check('SPACE/Page', 'signature'))
+        self.cache.flush()
+        self.assertTrue(UploadCache(self.dir / 'uploads.json').check('SPACE/Page', 'signature'))
+
+
+class TestPageStateCache(CacheTestCase):
+    def test_check(self):
+        cache = PageStateCache(self.dir / 'state.json')
+        cache.put('1', 5, 'Title', 'hash')
+        self.assertTrue(cache.check(1, 5, 'Title', 'hash'))
+        self.assertFalse(cache.check(1, 6, 'Title', 'hash'))
+        self.assertFalse(cache.check(1, 5, 'Other title', 'hash'))
+        self.assertFalse(cache.check(1, 5, 'Title', 'other hash'))
+        self.assertFalse(cache.check(2, 5, 'Title', 'hash'))
+
+    def test_flush_keeps_records_of_concurrent_builds(self):
+        path = self.dir / 'state.json'
+        first = PageStateCache(path)
+        second = PageStateCache(path)
+        first.put('1', 1, 'First', 'hash')
+        second.put('2', 1, 'Second', 'hash')
+        first.flush()
+        second.flush()
+        cache = PageStateCache(path)
+        self.assertTrue(cache.check('1', 1, 'First', 'hash'))
+        self.assertTrue(cache.check('2', 1, 'Second', 'hash'))
+        self.assertEqual(os.listdir(self.dir), ['state.json'])
+
+    def test_broken_file(self):
+        path = self.dir / 'state.json'
+        path.write_text('{', encoding='utf8')
+        cache = PageStateCache(path)
+        self.assertFalse(cache.check('1', 1, 'Title', 'hash'))
+        cache.put('1', 1, 'Title', 'hash')
+        cache.flush()
+        self.assertTrue(PageStateCache(path).check('1', 1, 'Title', 'hash'))
+
+
+class TestFileHashCache(CacheTestCase):
+    def test_changed_file(self):
+        path = self.dir / 'image.png'
+        path.write_bytes(b'image')
+        cache = FileHashCache(self.dir / 'hashes.json')
+        cache.put({path: 'hash'})
+        self.assertEqual(cache.get(path), 'hash')
+        path.write_bytes(b'changed image')
+        self.assertIsNone(cache.get(path))
+
+
+class TestFileCache(CacheTestCase):
+    def test_get(self):
+        cache = FileCache(self.dir / 'cache')
+        cache.put('key', 'result')
+        self.assertEqual(cache.get('key'), 'result')
+        # results of previous builds are read from disk
+        self.assertEqual(FileCache(self.dir / 'cache').get('key'), 'result')
+        self.assertIsNone(cache.get('other key'))
+
+    def test_evict_least_recently_used(self):
+        cache = FileCache(self.dir / 'cache', max_size=10)
+        for i, key in enumerate(('old', 'used', 'new')):
+            cache.put(key, '12345')
+            os.utime(self.dir / 'cache' / f'{key}.html', (i, i))
+        # reading a result marks it as used
+        FileCache(self.dir / 'cache').get('used')
+        cache.evict()
+        names = sorted(path.name for path in (self.dir / 'cache').iterdir())
+        self.assertEqual(names, ['new.html', 'used.html'])
+
+    def test_evict_within_max_size(self):
+        cache = FileCache(self.dir / 'cache', max_size=10)
+        cache.put('first', '12345')
+        cache.put('second', '12345')
+        cache.evict()
+        self.assertEqual(len(list((self.dir / 'cache').iterdir())), 2)
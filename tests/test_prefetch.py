@@ -0,0 +1,86 @@
+from unittest import TestCase
+from unittest.mock import Mock
+
+from foliant.backends.confluence.cache import PageCache
+from foliant.backends.confluence.wrapper import Page
+from foliant.backends.confluence.wrapper import _check_parent
+from foliant.backends.confluence.wrapper import _check_space
+
+
+def page_content(id_: str, title: str, version: int = 1) -> dict:
+    return {'id': id_,
+            'title': title,
+            'version': {'number': version},
+            'body': {'storage': {'value': '<p>text</p>'}},
+            '_links': {'base': 'https://confluence', 'webui': f'/pages/{id_}'}}
+
+
+def search_response(results: list) -> dict:
+    return {'results': results, '_links': {'base': 'https://confluence'}}
+
+
+class TestPrefetch(TestCase):
+    def setUp(self):
+        Page.clear_prefetched()
+        _check_space.cache_clear()
+        _check_parent.cache_clear()
+        self.con = Mock()
+        self.con.get_page_by_title.return_value = None
+
+    def test_hit(self):
+        self.con.get.return_value = search_response([page_content('1', 'Found')])
+        Page.prefetch(self.con, 'SPACE', None, ['Found'])
+        page = Page(self.con, 'SPACE', 'Found', cache=PageCache())
+        self.assertTrue(page.exists)
+        self.assertEqual(page.id, '1')
+        self.assertEqual(page.url, 'https://confluence/pages/1')
+        self.con.get_page_by_title.assert_not_called()
+        self.con.get_space.assert_not_called()
+
+    def test_miss_requested_by_title(self):
+        self.con.get.return_value = search_response([])
+        self.con.get_page_by_title.return_value = page_content('2', 'Not indexed')
+        Page.prefetch(self.con, 'SPACE', None, ['Not indexed'])
+        page = Page(self.con, 'SPACE', 'Not indexed', cache=PageCache())
+        self.assertTrue(page.exists)
+        self.assertEqual(page.id, '2')
+        self.con.get_page_by_title.assert_called_once()
+
+    def test_miss_of_missing_page(self):
+        self.con.get.return_value = search_response([])
+        Page.prefetch(self.con, 'SPACE', None, ['New'])
+        page = Page(self.con, 'SPACE', 'New', cache=PageCache())
+        self.assertFalse(page.exists)
+        self.con.get_page_by_title.assert_called_once()
+        self.con.get_space.assert_called_once_with('SPACE')
+
+    def test_title_in_different_case(self):
+        self.con.get.return_value = search_response([page_content('3', 'title')])
+        self.con.get_page_by_title.return_value = page_content('4', 'Title')
+        Page.prefetch(self.con, 'SPACE', None, ['Title'])
+        page = Page(self.con, 'SPACE', 'Title', cache=PageCache())
+        self.assertEqual(page.id, '4')
+        self.con.get_page_by_title.assert_called_once()
+
+    def test_prefetched_page_used_once(self):
+        self.con.get.return_value = search_response([page_content('1', 'Found')])
+        Page.prefetch(self.con, 'SPACE', None, ['Found'])
+        Page(self.con, 'SPACE', 'Found', cache=PageCache())
+        self.con.get_page_by_title.return_value = page_content('1', 'Found', 2)
+        page = Page(self.con, 'SPACE', 'Found', cache=PageCache())
+        self.assertEqual(page.version, 2)
+
+    def test_clear_prefetched(self):
+        self.con.get.return_value = search_response([page_content('1', 'Found')])
+        Page.prefetch(self.con, 'SPACE', None, ['Found'])
+        Page.clear_prefetched()
+        page = Page(self.con, 'SPACE', 'Found', cache=PageCache())
+        self.assertFalse(page.exists)
+        self.con.get_page_by_title.assert_called_once()
+
+    def test_other_parent_not_used(self):
+        self.con.get.return_value = search_response([page_content('1', 'Found')])
+        Page.prefetch(self.con, 'SPACE', '10', ['Found'])
+        Page(self.con, 'SPACE', 'Found', '20', cache=PageCache())
+        self.con.get_page_by_title.assert_called_once()
+        self.con.get_page_by_id.assert_called_once_with('20')
@@ -0,0 +1,25 @@
+from unittest import TestCase
+
+from foliant.backends.confluence.convert import unformat
+
+
+class TestUnformat(TestCase):
+    def test_whitespace_between_tags(self):
+        source = '<p>\n  <b>text</b>\n</p>\n<p>one</p> <p>two</p>'
+        self.assertEqual(unformat(source), '<p><b>text</b></p><p>one</p> <p>two</p>')
+
+    def test_tabs_collapse_to_space(self):
+        source = '<b>one</b>\t\t<i>two</i>\t<i>three</i>'
+        self.assertEqual(unformat(source), '<b>one</b> <i>two</i> <i>three</i>')
+
+    def test_pre_content_kept(self):
+        source = '<pre>\t<code>x</code>  <code>y</code>\t\t</pre>\n<pre>  </pre>'
+        self.assertEqual(unformat(source), source.replace('\n', ''))
+
+    def test_pre_trailing_newlines_removed(self):
+        source = '<pre>\nline 1\n\tline 2\n  \n</pre>'
+        self.assertEqual(unformat(source), '<pre>line 1\n\tline 2</pre>')
+
+    def test_cdata_and_comments_kept(self):
+        source = '<ac:plain-text-body><![CDATA[\n  code\n]]></ac:plain-text-body><!-- x\n -->'
+        self.assertEqual(unformat(source), source)
@@ -0,0 +1,86 @@
+import logging
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import Mock
+from unittest.mock import patch
+
+from foliant.contrib.combined_options import Options
+
+from foliant.backends.confluence.cache import PageCache
+from foliant.backends.confluence.cache import UploadCache
+from foliant.backends.confluence.uploader import PageUploader
+from foliant.backends.confluence.wrapper import Page
+
+SOURCE = '# Title\n\nText\n'
+
+
+class TestUploadCacheSkip(TestCase):
+    def setUp(self):
+        Page.clear_prefetched()
+        self.tmp = TemporaryDirectory()
+        self.dir = Path(self.tmp.name)
+        self.con = Mock()
+        self.con.get_page_by_title.return_value = {
+            'id': '1',
+            'title': 'Page',
+            'version': {'number': 3},
+            'body': {'storage': {'value': '<p>text</p>'}},
+            '_links': {'base': 'https://confluence', 'webui': '/pages/1'}
+        }
+        self.upload_cache = UploadCache(self.dir / 'uploads.json')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def make_uploader(self, **options) -> PageUploader:
+        config = Options({'space_key': 'SPACE',
+                          'title': 'Page',
+                          'pandoc_path': 'pandoc',
+                          'test_run': False,
+                          **options})
+        return PageUploader(self.dir / 'index.md',
+                            config,
+                            self.con,
+                            self.dir,
+                            self.dir / 'debug',
+                            self.dir / 'attachments',
+                            logging.getLogger('test'),
+                            PageCache(),
+                            self.dir / 'work',
+                            upload_cache=self.upload_cache)
+
+    def save_upload(self, uploader: PageUploader, version: int):
+        self.upload_cache.put(uploader._cache_key(), uploader._signature(SOURCE), version, [])
+
+    def test_skipped(self):
+        uploader = self.make_uploader()
+        self.save_upload(uploader, 3)
+        with patch('foliant.backends.confluence.uploader.md_to_editor') as md_to_editor:
+            result = uploader.upload(SOURCE)
+        md_to_editor.assert_not_called()
+        self.con.update_page.assert_not_called()
+        self.assertEqual(result, 'https://confluence/pages/1 (Page)')
+
+    def check_not_skipped(self, uploader: PageUploader):
+        # conversion is interrupted, the page is only checked for being skipped
+        with patch('foliant.backends.confluence.uploader.md_to_editor',
+                   side_effect=RuntimeError) as md_to_editor:
+            with self.assertRaises(RuntimeError):
+                uploader.upload(SOURCE)
+        md_to_editor.assert_called_once()
+
+    def test_page_changed_on_server(self):
+        uploader = self.make_uploader()
+        self.save_upload(uploader, 2)
+        self.check_not_skipped(uploader)
+
+    def test_options_changed(self):
+        self.save_upload(self.make_uploader(), 3)
+        self.check_not_skipped(self.make_uploader(toc=True))
+
+    def test_test_run(self):
+        uploader = self.make_uploader(test_run=True)
+        self.save_upload(uploader, 3)
+        self.check_not_skipped(uploader)